@@ -2,7 +2,7 @@ bl_info = {
     "name": "B-Labels",
     "author": "Jordan Hueckstaedt",
     "version": (1, 2),
-    "blender": (2, 63, 0),
+    "blender": (2, 70, 0),
     "location": "Properties > Shape Keys / Vertex Groups",
     "warning": "",  # used for warning icon and text in addons panel
     "description": "Allows the user to group shape keys into labels.\
@@ -14,24 +14,34 @@ bl_info = {
 }
 
 import bpy
+from . import label_core
+from . import label_io
 from . import blabels
 from . import shape_key_panel
 from . import vertex_group_panel
+from . import label_transfer
 
 
 def register():
     import imp
+    imp.reload(label_core)
+    imp.reload(label_io)
     imp.reload(blabels)
     imp.reload(shape_key_panel)
     imp.reload(vertex_group_panel)
+    imp.reload(label_transfer)
 
     # Register collections
     bpy.utils.register_class(blabels.IndexProperty)
+    bpy.utils.register_class(blabels.LabelPose)
     bpy.utils.register_class(blabels.IndexCollection)
 
+    blabels.register()
+
     # Register panel(s)
     shape_key_panel.register()
     vertex_group_panel.register()
+    label_transfer.register()
 
     bpy.utils.register_module(__name__)
 
@@ -39,13 +49,15 @@ def register():
 def unregister():
     bpy.utils.unregister_module(__name__)
 
-    # IndexProperty and IndexCollection are part of this module, so they
-    # are already unregistered in unregister_module.  They only needed to
-    # be registered explicitly, because they needed to be registered before
-    # specific panels.
+    # IndexProperty, LabelPose and IndexCollection are part of this module,
+    # so they are already unregistered in unregister_module.  They only
+    # needed to be registered explicitly, because they needed to be
+    # registered before specific panels.
 
+    label_transfer.unregister()
     vertex_group_panel.unregister()
     shape_key_panel.unregister()
+    blabels.unregister()
 
 
 if __name__ == "__main__":
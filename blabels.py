@@ -20,16 +20,231 @@ to a ui panel in Blender. '''
 
 import bpy
 from bpy.types import UIList
+from bpy.app.handlers import persistent
+from .label_core import *
+
+
+def get_indexes(collection):
+    ''' Contents of an IndexProperty collection, with a single foreach_get '''
+    indexes = new_array('i', len(collection))
+    if indexes:
+        collection.foreach_get('index', indexes)
+    return indexes
+
+
+def set_indexes(collection, indexes):
+    ''' Replace the contents of an IndexProperty collection.  The collection
+    is resized from the end and filled with a single foreach_set. '''
+    for x in range(len(collection) - len(indexes)):
+        collection.remove(len(collection) - 1)
+    for x in range(len(indexes) - len(collection)):
+        collection.add()
+    if indexes:
+        collection.foreach_set('index', array('i', indexes))
+
+
+# (class name, label owner pointer, object pointer) -> (signature, data).
+# The signature includes the fingerprint, so reconciling the items
+# invalidates them.
+name_indexes = {}
+search_results = {}
+
+# Same keys plus label index -> (query dependencies, item indexes, bitset)
+query_results = {}
+
+# Query labels being evaluated, to catch expressions that use themselves
+evaluating_queries = set()
+
+# Bumped whenever Blender tags objects or shape keys for an update (see
+# count_data_updates), and by Blabels.set_item_attribute.  Queries compare
+# it instead of reading every item on every redraw.
+data_version = 0
+
+# Same keys plus (attribute, typecode) -> (data_version, item count, array)
+item_attributes = {}
+
+# Same keys plus label index -> (packed indexes, bitset) of normal labels
+label_bits = {}
+
+# Same keys -> (packed uids and parents, LabelTree)
+label_trees = {}
+
+# Same keys -> LabelTree checked by UI_UL_Blabels.filter_items for the
+# current redraw, so drawing the rows doesn't check it again
+drawn_trees = {}
+
+# Same keys -> {label uid: bitset of the label and its descendants}.
+# Entries are dropped along the path to the root when a label is edited,
+# see Blabels.invalidate_labels.
+subtree_bits = {}
+
+# Same keys -> item index that shift-click selects from
+selection_anchors = {}
+
+# (class name, object name) -> [packed selection, fingerprint of the items
+# the selection points at, object pointer].  Selecting items is kept out of
+# the undo system, since an undo push can take hundreds of milliseconds on
+# a heavy file.  Undo still restores the items, so the selections are
+# remapped by name afterwards, see remap_live_selections.  They are written
+# to the objects when the file is saved, see store_selections.
+live_selections = {}
+
+
+
+def clear_search_cache():
+    item_attributes.clear()
+    name_indexes.clear()
+    search_results.clear()
+    query_results.clear()
+    label_bits.clear()
+    label_trees.clear()
+    drawn_trees.clear()
+    subtree_bits.clear()
+
+
+def clean_index_collection(collection, length):
+    ''' Drop out of range and repeated indexes from an IndexProperty
+    collection.  Only writes if something was wrong.  Returns the number of
+    indexes dropped. '''
+    indexes, out_of_range, duplicates = clean_indexes(get_indexes(collection), length)
+    if out_of_range or duplicates:
+        set_indexes(collection, indexes)
+    return out_of_range + duplicates
+
+
+def all_selected_property():
+    ''' The all_selected option of operators that use for_each_label_object '''
+    return bpy.props.BoolProperty(
+        name="All Selected Objects",
+        default=False,
+        description="Also run on every selected object, matching labels and items by name")
+
+
+def for_each_label_object(context, blabels_class, func, all_selected=False, match_label=True):
+    ''' Call func(label_accessor) for the context object.  With all_selected,
+    func is also called for every other selected object that can hold the
+    labels.
+
+    The other objects get their active label and selection matched to the
+    context object's by name first.  With match_label, objects without the
+    active label are skipped.  Objects that share label data (eg. shape key
+    labels on a shared mesh) are only run once.  Returns the result for the
+    context object. '''
+    source = blabels_class(context)
+    state = source.get_selection_state()
+    # Operators push undo themselves
+    with source.transaction():
+        result = func(source)
+
+    if all_selected:
+        done = set([source.label_owner])
+        for obj in context.selected_objects:
+            if obj == source.object or obj.type not in blabels_class.object_types:
+                continue
+            label_accessor = blabels_class(context, obj)
+            if label_accessor.label_owner in done:
+                continue
+            done.add(label_accessor.label_owner)
+
+            if not label_accessor.set_selection_state(state) and match_label:
+                continue
+            with label_accessor.transaction():
+                func(label_accessor)
+    return result
+
+
+def copy_to_label_func(context, blabels_class, label_index):
+    ''' Function for for_each_label_object, copying the selection to the
+    label with the same name as label_index on the context object. '''
+    name = blabels_class(context).labels[label_index].name
+
+    def copy_to_label(label_accessor):
+        index = label_accessor.find_label(name)
+        if index > 0:
+            return label_accessor.copy_item(index)
+    return copy_to_label
+
+
+class LabelTransaction(object):
+    ''' Context manager returned by Blabels.transaction '''
+    def __init__(self, label_accessor, undo_push=False, message="Edit Labels"):
+        self.label_accessor = label_accessor
+        self.undo_push = undo_push
+        self.message = message
+        self.nested = False
+
+        # label uid -> array('i') of pending item indexes
+        self.labels = {}
+
+    def __enter__(self):
+        label_accessor = self.label_accessor
+        if label_accessor._transaction is not None:
+            # Part of the outer transaction
+            self.nested = True
+            return label_accessor._transaction
+
+        label_accessor.reconcile()
+        label_accessor.ensure_uids()
+        self.selection = label_accessor.selection
+        self.active_item_index = label_accessor.active_item_index
+        label_accessor._transaction = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.nested:
+            return False
+        self.label_accessor._transaction = None
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def commit(self):
+        label_accessor = self.label_accessor
+        for label in label_accessor.labels:
+            if label.uid in self.labels:
+                set_indexes(label.indexes, self.labels[label.uid])
+        self.labels.clear()
+        label_accessor.update_fingerprint()
+        label_accessor.invalidate_labels()
+        if self.undo_push:
+            bpy.ops.ed.undo_push(message=self.message)
+
+    def rollback(self):
+        # The fingerprint is still from before the transaction, so
+        # reconciling remaps the stored labels and the old selection to
+        # whatever items were added, moved or deleted.
+        label_accessor = self.label_accessor
+        self.labels.clear()
+        label_accessor.selection = self.selection
+        if self.active_item_index < len(label_accessor.items):
+            label_accessor.active_item_index = self.active_item_index
+        label_accessor.reconcile()
+        label_accessor.invalidate_labels()
+
 
 class Blabels(object):
-    def __init__(self, context=None):
+    def __init__(self, context=None, obj=None):
         if context is None:
             self.context = bpy.context
         else:
             self.context = context  # ?? save context?  or have everything pass it around?
 
+        # Object to work on, when it isn't the context's object
+        self._object = obj
+
+        # Open LabelTransaction, see transaction
+        self._transaction = None
+
+        # LabelTree to use without checking it, while drawing
+        self._label_tree = None
+
+        # New index -> old name hash of the items reconcile found renamed,
+        # for apply_rules
+        self._renamed = {}
+
         # shape_key_labels = bpy.props.CollectionProperty(type=IndexCollection)
-        # selected_shape_keys = bpy.props.CollectionProperty(type=IndexProperty)
         # active_shape_key_label_index = bpy.props.IntProperty(default = 0, update=label_index_updated)
 
     # Override these, or use the ones in init?
@@ -42,10 +257,52 @@ class Blabels(object):
         raise NotImplementedError
 
     @property
-    def selected_items(self):
-        '''Selected items in the active label'''
+    def stored_selection(self):
+        '''Selection saved in the file, packed with indexes_to_ranges'''
+        raise NotImplementedError
+
+    @stored_selection.setter
+    def stored_selection(self, data):
         raise NotImplementedError
 
+    @property
+    def selection(self):
+        '''Selected items, packed with indexes_to_ranges.  Lives in
+        live_selections, so clicking through items never touches undo.'''
+        entry = self._get_live_selection()
+        if entry is None:
+            return self.stored_selection
+        return entry[0]
+
+    @selection.setter
+    def selection(self, data):
+        live_selections[self._selection_key()] = [data, self.fingerprint, self.object.as_pointer()]
+
+    def _get_live_selection(self):
+        # This object's entry in live_selections, or None
+        key = self._selection_key()
+        pointer = self.object.as_pointer()
+        entry = live_selections.get(key)
+        if entry is not None and entry[2] != pointer:
+            # Another object took the name.  Pointers only change on undo,
+            # and remap_live_selections updates them then.
+            del live_selections[key]
+            entry = None
+        if entry is None:
+            # The object may have been renamed
+            for other_key, other in list(live_selections.items()):
+                if other_key[0] == key[0] and other[2] == pointer:
+                    del live_selections[other_key]
+                    live_selections[key] = entry = other
+                    break
+        return entry
+
+    def _tag_selection(self):
+        # The selection now points at the items the fingerprint describes
+        entry = self._get_live_selection()
+        if entry is not None:
+            entry[1] = self.fingerprint
+
     @property
     def active_index(self):
         '''Active label index getter'''
@@ -88,11 +345,70 @@ class Blabels(object):
         # Original call to remove item
         raise NotImplementedError
 
-    def move_item_orig(self, *move_item_kwargs):
+    def move_item_orig(self, **move_item_kwargs):
         # Original call to move item
         raise NotImplementedError
 
+    @property
+    def fingerprint(self):
+        ''' Item name hashes as of the last reconcile, packed with
+        label_core.pack_array '''
+        raise NotImplementedError
+
+    @fingerprint.setter
+    def fingerprint(self, data):
+        raise NotImplementedError
+
+    @property
+    def search(self):
+        ''' (text, mode) of the item name search.  mode is one of the modes
+        of label_core.search_names. '''
+        raise NotImplementedError
+
+    @property
+    def page(self):
+        ''' Page of the item list being drawn '''
+        raise NotImplementedError
+
+    @page.setter
+    def page(self, page):
+        raise NotImplementedError
+
+    @property
+    def page_size(self):
+        ''' Items drawn per page, 0 to draw every item '''
+        raise NotImplementedError
+
+    # Object types that can hold these labels
+    object_types = {'MESH', 'LATTICE', 'CURVE', 'SURFACE'}
+
+    # Object property older versions saved the selection in, as an
+    # IndexProperty collection.  See migrate_selection.
+    legacy_selection = None
+
     # END of functions that need overrides to work.
+    @property
+    def object(self):
+        if self._object is None:
+            return self.context.object
+        return self._object
+
+    @property
+    def label_owner(self):
+        ''' Datablock the labels are stored on.  Objects sharing it share
+        labels. '''
+        return self.object
+
+    def call_operator(self, operator, **kwargs):
+        ''' Call a bpy.ops operator on self.object, overriding the context if
+        self.object isn't the context's object. '''
+        if self._object is None or self._object == self.context.object:
+            return operator(**kwargs)
+
+        override = self.context.copy()
+        override['object'] = override['active_object'] = self._object
+        return operator(override, **kwargs)
+
     @property
     def active_item(self):
         return self.items[self.active_item_index]
@@ -108,14 +424,503 @@ class Blabels(object):
         label = self.labels[index]
         if index == 0:
             return self.items
+        elif label.is_query or self.get_label_tree().children.get(index):
+            items = self.items
+            return [items[i] for i in self.get_label_indexes(index)]
+        else:
+            items = self.items
+            num_items = len(items)
+            return [items[i] for i in self.get_stored_indexes(label) if -1 < i < num_items]
+
+    def get_label_indexes(self, index=None):
+        ''' Item indexes in a label, in label order.  Out of range indexes
+        are skipped. '''
+        if index is None:
+            index = self.active_index
+
+        num_items = len(self.items)
+        if index == 0:
+            return list(range(num_items))
+        if self.labels[index].is_query:
+            indexes = list(self.get_query_indexes(index))
         else:
-            items = []
-            for i in label.indexes:
+            indexes = [i for i in self.get_stored_indexes(self.labels[index]) if -1 < i < num_items]
+        return self._add_descendant_indexes(index, indexes)
+
+    def get_stored_indexes(self, label):
+        ''' Item indexes stored in a label, as a new array('i').  Includes
+        edits waiting in an open transaction. '''
+        transaction = self._transaction
+        if transaction is not None and label.uid in transaction.labels:
+            return array('i', transaction.labels[label.uid])
+        return get_indexes(label.indexes)
+
+    def set_stored_indexes(self, label, indexes):
+        ''' Replace the item indexes stored in a label.  Inside a transaction
+        nothing is written until it commits. '''
+        transaction = self._transaction
+        if transaction is not None:
+            transaction.labels[label.uid] = array('i', indexes)
+        else:
+            set_indexes(label.indexes, indexes)
+
+    def transaction(self, undo_push=False, message="Edit Labels"):
+        ''' Batch label edits:
+
+            with label_accessor.transaction():
+                label_accessor.copy_item(2)
+                label_accessor.move_item('down')
+
+        Label contents are kept in memory until the block ends, then
+        written once.  If the block raises, the
+        pending edits and selection are dropped and the labels are
+        reconciled with the items as they are now.  Items and labels added
+        or removed inside the block stay that way, Blender has already done
+        that part.
+
+        Only edits made through this Blabels are batched.  Operators push
+        undo themselves, so there's no undo push unless undo_push is given,
+        eg. from a script. '''
+        return LabelTransaction(self, undo_push, message)
+
+    def get_query_dependencies(self, label):
+        ''' Hashable signature of everything label's query reads, so the
+        results are only evaluated again when one of them changes.  Called
+        on every redraw, so it must stay cheap.  The default covers the
+        query settings, the item names and data_version. '''
+        return (tuple(getattr(label, name) for name in QUERY_SETTINGS), self._names_signature(), data_version)
+
+    def evaluate_query(self, label):
+        ''' Item indexes matching label's query, in item order '''
+        raise NotImplementedError
+
+    def get_query_indexes(self, index):
+        ''' Item indexes of a query label.  Cached until the query's
+        dependencies change. '''
+        return self._get_query(index)[1]
+
+    def _get_query(self, index):
+        # (dependencies, indexes, bitset) of a query label
+        label = self.labels[index]
+        key = self._cache_key() + (index,)
+        if key in evaluating_queries:
+            raise LabelCycleError("%s is part of its own expression" % label.name)
+
+        evaluating_queries.add(key)
+        try:
+            # The operand bitsets are part of the dependencies, so edits to
+            # the labels in the expression are picked up.
+            expression_bits = None
+            if label.query_expression:
                 try:
-                    items.append(self.items[i.index])
-                except IndexError:
-                    continue
-            return items
+                    expression_bits = self.evaluate_expression(label.query_expression)
+                except LabelCycleError:
+                    # evaluating_queries holds the queries being evaluated
+                    # around this one.  Let the loop reach the outermost, so
+                    # check_query_expression sees it too.
+                    if len(evaluating_queries) > 1:
+                        raise
+                    expression_bits = 0
+                except LabelExpressionError:
+                    expression_bits = 0
+
+            signature = (self.get_query_dependencies(label), expression_bits)
+            cached = query_results.get(key)
+            if cached is None or cached[0] != signature:
+                indexes = self.evaluate_query(label)
+                if expression_bits is not None:
+                    in_expression = set(bits_to_indexes(expression_bits))
+                    indexes = [i for i in indexes if i in in_expression]
+                cached = (signature, tuple(indexes), indexes_to_bits(indexes))
+                query_results[key] = cached
+        finally:
+            evaluating_queries.discard(key)
+        return cached
+
+    def get_label_bits(self, index):
+        ''' Label membership as a python int used as a bitset, with bit i set
+        for item i '''
+        if index == 0:
+            return (1 << len(self.items)) - 1
+
+        label = self.labels[index]
+        if label.is_query:
+            return self._get_query(index)[2]
+
+        indexes = self.get_stored_indexes(label)
+        data = indexes.tobytes()
+        key = self._cache_key() + (index,)
+        cached = label_bits.get(key)
+        if cached is None or cached[0] != data:
+            num_items = len(self.items)
+            cached = (data, indexes_to_bits(i for i in indexes if -1 < i < num_items))
+            label_bits[key] = cached
+        return cached[1]
+
+    def evaluate_expression(self, text):
+        ''' Bitset of a label expression, like 'Mouth - "Lip Correctives"'.
+        See label_core.parse_label_expression.  Raises LabelExpressionError
+        for bad expressions. '''
+        tree = parse_label_expression(text)
+
+        def get_bits(name):
+            index = self.find_label(name)
+            if index < 0:
+                raise LabelExpressionError("No label called %s" % name)
+            return self.get_subtree_bits(index)
+        return evaluate_label_expression(tree, get_bits)
+
+    def check_query_expression(self, index):
+        ''' Evaluate the expression of a query label as part of the label,
+        so expressions that use the label itself raise LabelCycleError.
+        Raises LabelExpressionError for bad expressions. '''
+        key = self._cache_key() + (index,)
+        evaluating_queries.add(key)
+        try:
+            self.evaluate_expression(self.labels[index].query_expression)
+        finally:
+            evaluating_queries.discard(key)
+
+    def ensure_uids(self):
+        ''' Give labels without a uid (eg. from older files) one, so they can
+        be parents '''
+        labels = self.labels
+        next_uid = max([label.uid for label in labels] or [0]) + 1
+        for x in range(1, len(labels)):
+            if not labels[x].uid:
+                labels[x].uid = next_uid
+                next_uid += 1
+
+    def get_label_tree(self):
+        ''' LabelTree of the labels.  Cached until a uid, parent or query
+        flag changes. '''
+        if self._label_tree is not None:
+            return self._label_tree
+        labels = self.labels
+        uids = new_array('i', len(labels))
+        parents = new_array('i', len(labels))
+        queries = new_array('b', len(labels))
+        if labels:
+            labels.foreach_get('uid', uids)
+            labels.foreach_get('parent_uid', parents)
+            labels.foreach_get('is_query', queries)
+
+        data = uids.tobytes() + parents.tobytes() + queries.tobytes()
+        key = self._cache_key()
+        cached = label_trees.get(key)
+        if cached is None or cached[0] != data:
+            cached = (data, LabelTree(uids, parents, queries))
+            label_trees[key] = cached
+        return cached[1]
+
+    def invalidate_labels(self, index=None):
+        ''' Forget the cached subtree of a label and of every label above
+        it, after the label's items changed.  Without an index, every
+        subtree is forgotten. '''
+        key = self._cache_key()
+        if index is None:
+            subtree_bits.pop(key, None)
+            return
+
+        cache = subtree_bits.get(key)
+        if cache and index > 0:
+            labels = self.labels
+            for x in self.get_label_tree().path_to_root(index):
+                cache.pop(labels[x].uid, None)
+
+    def get_subtree_bits(self, index):
+        ''' Bitset of a label and all of its descendants.  Cached per label
+        unless there's a query label in the subtree, since query results
+        change without the labels being edited. '''
+        tree = self.get_label_tree()
+        children = tree.children.get(index) if index > 0 else None
+        if not children:
+            return self.get_label_bits(index)
+
+        uid = self.labels[index].uid
+        cache = subtree_bits.setdefault(self._cache_key(), {})
+        bits = cache.get(uid)
+        if bits is None:
+            bits = self.get_label_bits(index)
+            for child in children:
+                bits |= self.get_subtree_bits(child)
+            if index not in tree.volatile:
+                cache[uid] = bits
+        return bits
+
+    def _add_descendant_indexes(self, index, indexes):
+        # A label's own items in label order, then the rest of its subtree
+        # in item order
+        if index < 1 or not self.get_label_tree().children.get(index):
+            return indexes
+        own = set(indexes)
+        return indexes + [i for i in bits_to_indexes(self.get_subtree_bits(index)) if i not in own]
+
+    def set_label_parent(self, direction):
+        ''' Indent ('IN') the active label under the label above it in the
+        tree, or outdent ('OUT') it to its parent's level. '''
+        index = self.active_index
+        if index < 1:
+            return
+        self.ensure_uids()
+        labels = self.labels
+        tree = self.get_label_tree()
+        label = labels[index]
+
+        if direction == 'IN':
+            siblings = tree.children[tree.parent_of[index]]
+            position = siblings.index(index)
+            if position == 0:
+                return
+            label.parent_uid = labels[siblings[position - 1]].uid
+            labels[siblings[position - 1]].expanded = True
+        else:
+            parent = tree.parent_of[index]
+            if not parent:
+                return
+            label.parent_uid = labels[parent].parent_uid
+        self.invalidate_labels()
+
+    def get_item_attribute(self, attr, typecode='f'):
+        ''' Read an attribute of every item with a single foreach_get '''
+        items = self.items
+        values = new_array(typecode, len(items))
+        if values:
+            items.foreach_get(attr, values)
+        return values
+
+    def get_cached_attribute(self, attr, typecode='f'):
+        ''' get_item_attribute, read again only when data_version or the
+        item count changes.  The array is shared, so don't change it. '''
+        key = self._cache_key() + (attr, typecode)
+        signature = (data_version, len(self.items))
+        cached = item_attributes.get(key)
+        if cached is None or cached[0] != signature:
+            cached = (signature, self.get_item_attribute(attr, typecode))
+            item_attributes[key] = cached
+        return cached[1]
+
+    def set_item_attribute(self, attr, values):
+        ''' Write an attribute of every item with a single foreach_set, and
+        tag the object's data so the viewport shows the change. '''
+        global data_version
+        if values:
+            self.items.foreach_set(attr, values)
+            # foreach_set doesn't tag anything for an update
+            self.object.data.update_tag()
+            data_version += 1
+
+    def migrate_selection(self):
+        ''' Move a selection saved by an older version into
+        stored_selection, and delete the old property.  The old property
+        isn't registered any more, but its ID properties are still in the
+        file.  Returns True if there was one. '''
+        obj = self.object
+        name = self.legacy_selection
+        if not name or obj.library or name not in obj:
+            return False
+        indexes = sorted(set(item.get('index', 0) for item in obj[name]))
+        if not self.stored_selection:
+            self.stored_selection = pack_array('i', indexes_to_ranges([i for i in indexes if i > -1]))
+        del obj[name]
+        return True
+
+    def get_selected(self):
+        ''' Sorted indexes of the selected items '''
+        return ranges_to_indexes(unpack_array('i', self.selection))
+
+    def _store_selected(self, indexes):
+        # One string write, however many items are selected
+        self.selection = pack_array('i', indexes_to_ranges(indexes))
+
+    def set_selected(self, indexes, active=None):
+        ''' Replace the selection.  The active item defaults to the last
+        selected item. '''
+        self._store_selected(indexes)
+        if active is None and indexes:
+            active = indexes[-1]
+        if active is not None:
+            self.active_item_index = active
+
+    def get_selection_state(self):
+        ''' Active label and selected item names, for set_selection_state '''
+        items = self.items
+        label = None
+        if self.labels and self.active_index < len(self.labels):
+            label = self.active_label.name
+        selected = [items[i].name for i in self.get_selected() if i < len(items)]
+        active = None
+        if -1 < self.active_item_index < len(items):
+            active = items[self.active_item_index].name
+        return label, selected, active
+
+    def set_selection_state(self, state):
+        ''' Match the active label and selection to a state from
+        get_selection_state, by name.  Returns False if the label is
+        missing. '''
+        label, selected, active = state
+        if label is not None:
+            index = self.find_label(label)
+            if index < 0:
+                return False
+            self.active_index = index
+
+        lookup = dict((item.name, x) for x, item in enumerate(self.items))
+        self.set_selected([lookup[name] for name in selected if name in lookup], lookup.get(active))
+        return True
+
+    def update_fingerprint(self):
+        ''' Remember the current items, after Blabels changed them itself '''
+        if self._transaction is not None:
+            # Once, when the transaction commits
+            return
+        self.fingerprint = pack_array('I', name_hashes(self.get_item_names()))
+        self._tag_selection()
+
+    def reconcile(self):
+        ''' Fix labels and the selection after items were reordered, renamed,
+        added or deleted outside of Blabels (eg. by object.shape_key_move).
+        Returns True if anything was remapped. '''
+        if self._transaction is not None:
+            # Done when the transaction opened.  The fingerprint isn't
+            # updated until it closes, so every change would look new.
+            return False
+        hashes = name_hashes(self.get_item_names())
+        old_data = self.fingerprint
+        data = pack_array('I', hashes)
+        if data == old_data:
+            return False
+        self.fingerprint = data
+        self._tag_selection()
+        if not old_data:
+            # Nothing to compare to yet
+            return False
+
+        old_hashes = unpack_array('I', old_data)
+        remap = diff_name_hashes(old_hashes, hashes)
+        self._renamed = dict((i, old_hashes[x]) for x, i in enumerate(remap) if i > -1 and hashes[i] != old_hashes[x])
+        if all(x == i for x, i in enumerate(remap)):
+            # Only added at the end
+            return False
+        self.remap_items(remap)
+        return True
+
+    def remap_items(self, remap):
+        ''' Point every label and the selection at new item indexes.  remap
+        maps old indexes to new ones, or -1 to drop them. '''
+        num_old = len(remap)
+
+        for label in self.labels[1:]:
+            indexes = self.get_stored_indexes(label)
+            self.set_stored_indexes(label, [remap[i] for i in indexes if -1 < i < num_old and remap[i] > -1])
+        self._store_selected([remap[i] for i in self.get_selected() if i < num_old and remap[i] > -1])
+        self.invalidate_labels()
+
+    def validate(self):
+        ''' Reconcile, then repair every label and the selection in one
+        batch.  Returns the number of indexes dropped.
+
+        Called from the handlers at the bottom of this module, so drawing
+        never has to fix anything. '''
+        labels = self.labels
+        if not labels:
+            return 0
+        self.reconcile()
+
+        self.ensure_uids()
+        num_items = len(self.items)
+        dropped = 0
+        for label in labels[1:]:
+            dropped += clean_index_collection(label.indexes, num_items)
+        selected = self.get_selected()
+        if selected and selected[-1] >= num_items:
+            kept = [i for i in selected if i < num_items]
+            dropped += len(selected) - len(kept)
+            self._store_selected(kept)
+        if dropped:
+            self.invalidate_labels()
+        if self.active_index >= len(labels):
+            self.active_index = len(labels) - 1
+
+        # New and renamed items
+        self.apply_rules()
+        return dropped
+
+    def apply_rules(self, full=False):
+        ''' Add items to the labels whose rules match their names.  Only
+        items added or renamed since the last call are checked, unless full
+        is given.  Items the rules added are taken out again when they're
+        renamed so they no longer match.  Otherwise rules only add items, so
+        items taken out of a label by hand stay out until a full run or the
+        rules change.  The names already checked are saved with each label,
+        so that holds across undo and reloading too.  Returns the number of
+        items added. '''
+        renamed = self._renamed
+        self._renamed = {}
+        labels = self.labels
+        rules = []
+        for x in range(1, len(labels)):
+            if labels[x].is_query:
+                continue
+            match = compile_rules(labels[x].rules)
+            if match:
+                rules.append((x, match))
+        if not rules:
+            return 0
+
+        names = self.get_item_names()
+        hashes = name_hashes(names)
+        checked = pack_array('I', sorted(set(hashes)))
+
+        # Labels usually share what they have checked, so group them and
+        # find the new items once per group
+        groups = {}
+        for x, match in rules:
+            label = labels[x]
+            data = '' if full or label.rules_checked != label.rules else label.rules_evaluated
+            groups.setdefault(data, []).append((x, match))
+
+        found = dict((x, []) for x, match in rules)
+        lost = dict((x, []) for x, match in rules)
+        current = set(hashes)
+        for data, group in groups.items():
+            if data == checked:
+                continue
+            evaluated = set(unpack_array('I', data))
+            for i, h in enumerate(hashes):
+                if h not in evaluated:
+                    name = names[i]
+                    for x, match in group:
+                        if match(name):
+                            found[x].append(i)
+                        elif i in renamed:
+                            lost[x].append(i)
+            for x, match in group:
+                label = labels[x]
+                old_matched = set(unpack_array('I', label.rules_matched))
+                # Only take out items the rules matched under their old name
+                lost[x] = [i for i in lost[x] if renamed[i] in old_matched]
+                matched = old_matched & current if data else set()
+                matched.update(hashes[i] for i in found[x])
+                label.rules_matched = pack_array('I', sorted(matched))
+                label.rules_evaluated = checked
+                label.rules_checked = label.rules
+
+        added = 0
+        for x in found:
+            indexes = found[x]
+            removed = set(lost[x])
+            if not indexes and not removed:
+                continue
+            existing = self.get_stored_indexes(labels[x])
+            existing_set = set(existing)
+            indexes = [i for i in indexes if i not in existing_set]
+            kept = [i for i in existing if i not in removed]
+            if indexes or len(kept) != len(existing):
+                self.set_stored_indexes(labels[x], kept + indexes)
+                self.invalidate_labels(x)
+                added += len(indexes)
+        return added
 
     def get_num_items(self, index=None):
         if index is None:
@@ -124,30 +929,166 @@ class Blabels(object):
         label = self.labels[index]
         if index == 0:
             return len(self.items)
+        elif self.get_label_tree().children.get(index):
+            return bin(self.get_subtree_bits(index)).count('1')
+        elif label.is_query:
+            return len(self.get_query_indexes(index))
         else:
-            return len(label.indexes)
+            return len(self.get_stored_indexes(label))
 
-    def add(self):
+    def add(self, name=None):
+        # Start tracking the items before there are labels to break
+        self.reconcile()
         labels = self.labels
         keys = labels.keys()
         label = labels.add()
 
         if not keys:
             label.name = "All"
+        elif name is not None:
+            label.name = name
         else:
             label.name = "Label %d" % len(keys)
+        self.ensure_uids()
 
         index = len(labels.keys()) - 1
         self.active_index = index
 
+    def find_label(self, name):
+        ''' Index of the first label called name, or -1 '''
+        for x, label in enumerate(self.labels):
+            if label.name == name:
+                return x
+        return -1
+
+    def set_label(self, name, indexes):
+        ''' Create or replace the label called name, so it holds indexes.
+        Returns the label's index. '''
+        self.reconcile()
+        index = self.find_label(name)
+        if index < 1:
+            if not self.labels:
+                self.add()
+            self.add(name)
+            index = len(self.labels) - 1
+        self.labels[index].is_query = False
+        self.set_stored_indexes(self.labels[index], indexes)
+        self.invalidate_labels(index)
+        return index
+
+    def get_label_data(self):
+        ''' Labels as a label_io section '''
+        return {
+            'items': [item.name for item in self.items],
+            'labels': [self._get_label_entry(label) for label in self.labels],
+            'active_label': self.active_index,
+            'view_mode': self.view_mode,
+            }
+
+    def _get_label_entry(self, label):
+        entry = {'name': label.name, 'indexes': list(self.get_stored_indexes(label)), 'rules': label.rules}
+        if label.is_query:
+            entry['query'] = dict((name, getattr(label, name)) for name in QUERY_SETTINGS)
+        if label.parent_uid:
+            for parent in self.labels:
+                if parent.uid == label.parent_uid:
+                    entry['parent'] = parent.name
+                    break
+        return entry
+
+    def set_label_data(self, section, merge=False):
+        ''' Replace the labels with the ones in a label_io section.  With
+        merge, labels are added to the existing labels, and labels with the
+        same name are combined.
+
+        Items are matched by name.  Returns the names of labeled items that
+        didn't match an item. '''
+        with self.transaction():
+            return self._set_label_data(section, merge)
+
+    def _set_label_data(self, section, merge):
+        labels = self.labels
+        item_names = section.get('items', [])
+        remap = remap_indexes(item_names, [item.name for item in self.items])
+        unmatched = []
+        unmatched_set = set()
+
+        parents = []
+        if not merge:
+            labels.clear()
+            if self._transaction is not None:
+                # The uids are handed out again
+                self._transaction.labels.clear()
+
+        for x, label_data in enumerate(section.get('labels', [])):
+            if x == 0:
+                # "All"
+                if not labels:
+                    self.add()
+                continue
+
+            indexes = []
+            for i in label_data.get('indexes', []):
+                if -1 < i < len(remap) and remap[i] > -1:
+                    indexes.append(remap[i])
+                elif i not in unmatched_set:
+                    unmatched_set.add(i)
+                    unmatched.append(item_names[i] if -1 < i < len(item_names) else "#%d" % i)
+
+            index = self.find_label(label_data['name']) if merge else -1
+            if index > 0:
+                existing = list(self.get_stored_indexes(labels[index]))
+                existing_set = set(existing)
+                indexes = existing + [i for i in indexes if i not in existing_set]
+            else:
+                self.add(label_data['name'])
+                index = len(labels) - 1
+            self.set_stored_indexes(labels[index], indexes)
+            if label_data.get('rules'):
+                labels[index].rules = label_data['rules']
+            if label_data.get('query'):
+                labels[index].is_query = True
+                for name, value in label_data['query'].items():
+                    if name in QUERY_SETTINGS:
+                        setattr(labels[index], name, value)
+            if label_data.get('parent'):
+                parents.append((index, label_data['parent']))
+
+        # Parents are found once every label exists
+        for index, parent in parents:
+            parent_index = self.find_label(parent)
+            if parent_index > 0 and parent_index != index:
+                labels[index].parent_uid = labels[parent_index].uid
+        self.invalidate_labels()
+
+        if not merge and labels:
+            self.active_index = max(0, min(section.get('active_label', 0), len(labels) - 1))
+            if 'view_mode' in section:
+                try:
+                    self.view_mode = section['view_mode']
+                except TypeError:
+                    # Not a view mode of this panel
+                    pass
+        self.update_fingerprint()
+        return unmatched
+
     def remove(self):
         labels = self.labels
         keys = labels.keys()
         index = self.active_index
 
         if keys and (index != 0 or len(keys) == 1):
+            # Children move up to the removed label's parent
+            label = labels[index]
+            for other in labels:
+                if label.uid and other.parent_uid == label.uid:
+                    other.parent_uid = label.parent_uid
+            if self._transaction is not None:
+                # A new label may get the same uid
+                self._transaction.labels.pop(label.uid, None)
             labels.remove(index)
             self.active_index = min(len(keys) - 2, index)
+            self.invalidate_labels()
 
     def move(self, direction='up'):
         # Gather data
@@ -166,39 +1107,55 @@ class Blabels(object):
                     labels.move(index, index + 1)
                     self.active_index = index + 1
 
-    def select_item(self, index, add=False):
-        if index > -1:
-            sel = self.selected_items
-
-            if not add:
-                # Clear selected if shift isn't used
-                for x in range(len(sel)):
-                    sel.remove(0)
+    def select_item(self, index, add=False, extend=False):
+        ''' Click on an item.  add toggles it in the selection (ctrl).
+        extend selects every visible item from the last clicked item to
+        this one (shift), keeping the rest of the selection if add is
+        also given. '''
+        if index < 0:
+            return
+        key = self._cache_key()
+
+        if extend:
+            indexes = self.get_visible_item_indexes()[0]
+            anchor = selection_anchors.get(key, self.active_item_index)
+            selected = set(self.get_selected()) if add else set()
+            if anchor in indexes and index in indexes:
+                start, end = sorted((indexes.index(anchor), indexes.index(index)))
+                selected.update(indexes[start:end + 1])
             else:
-                for x, key in enumerate(sel):
-                    # Clicked twice - deselect
-                    if index == key.index:
-                        if self.active_item_index == index:
-                            # Adjust active index.
-                            if len(sel) > 1:
-                                sel.remove(x)
-                                self.active_item_index = sel[-1].index
-                        else:
-                            sel.remove(x)
-                        return
-
-            # Set active
+                selected.add(index)
+            # The anchor stays put, so the range can be dragged out again
             self.active_item_index = index
+            self._store_selected(selected)
+            return
 
-            # Add to selected
-            i = sel.add()
-            i.index = index
+        selection_anchors[key] = index
+        if add:
+            selected = set(self.get_selected())
+            if index in selected:
+                # Clicked twice - deselect
+                if self.active_item_index != index:
+                    selected.discard(index)
+                elif len(selected) > 1:
+                    # Adjust active index.
+                    selected.discard(index)
+                    self.active_item_index = min(selected, key=lambda i: abs(i - index))
+                self._store_selected(selected)
+                return
+            selected.add(index)
+        else:
+            selected = [index]
+
+        # Set active
+        self.active_item_index = index
+        self._store_selected(selected)
 
 
     # Item related - Might move these to a different class.
     def get_visible_selection(self, indexes):
         # Get selected
-        selected = [i.index for i in self.selected_items]
+        selected = self.get_selected()
         if not selected:
             selected = [self.active_item_index]
         selected = set(selected)
@@ -213,14 +1170,8 @@ class Blabels(object):
         indexes = []
 
         if index != 0 and labels and len(labels):
-            # Invalid State Check (only fixes out of range states)
-            item_indexes = labels[index].indexes
-            for x in reversed(range(len(item_indexes))):
-                if item_indexes[x].index >= len(items):
-                    item_indexes.remove(x)
-
-            # Find indexes in label
-            indexes = [i.index for i in item_indexes if i.index > -1]
+            # Read only.  Bad indexes are repaired by validate.
+            indexes = self.get_label_indexes(index)
         else:
             indexes = [i for i in range(len(items))]
 
@@ -234,108 +1185,203 @@ class Blabels(object):
                 elif view_mode == 'UNLABELED':
                     indexes_set = set(indexes)
                     labels = self.labels
-                    for label in labels:
-                        for label_indexes in label.indexes:
-                            if label_indexes.index in indexes_set:
-                                indexes_set.remove(label_indexes.index)
-                            if not indexes_set:
-                                break
+                    for label in labels[1:]:
+                        indexes_set.difference_update(self.get_stored_indexes(label))
                         if not indexes_set:
                             break
                     indexes = [i for i in indexes if i in indexes_set]
                     selected = [i for i in selected if i in indexes]
                 else:
                     indexes, selected = self.filter_view_mode(indexes, selected)
+
+                matches = self.get_search_matches()
+                if matches is not None:
+                    indexes = [i for i in indexes if i in matches]
+                    selected = [i for i in selected if i in matches]
         return indexes, selected
 
+    def _selection_key(self):
+        # Pointers change with every undo step, names don't
+        return type(self).__name__, self.object.name
+
+    def _cache_key(self):
+        return (type(self).__name__, self.label_owner.as_pointer(), self.object.as_pointer())
+
+    def get_item_names(self):
+        ''' Names of every item.  keys() reads them in one call, much
+        faster than going through each item. '''
+        items = self.items
+        if not items:
+            return []
+        return items.keys()
+
+    def _names_signature(self):
+        # Any rename changes it, not just the ones reconcile has seen
+        names = self.get_item_names()
+        return len(names), names_checksum(names)
+
+    def get_lowercase_names(self):
+        ''' Lowercased item names.  Cached until an item is renamed, added
+        or removed. '''
+        key = self._cache_key()
+        names = self.get_item_names()
+        signature = (len(names), names_checksum(names))
+        cached = name_indexes.get(key)
+        if cached is None or cached[0] != signature:
+            cached = (signature, [name.lower() for name in names])
+            name_indexes[key] = cached
+        return cached[1]
+
+    def get_search_matches(self):
+        ''' Set of item indexes matching the search, or None when there is no
+        (valid) search. '''
+        text, mode = self.search
+        if not text:
+            return None
+
+        key = self._cache_key()
+        signature = (self._names_signature(), text, mode)
+        cached = search_results.get(key)
+        if cached is None or cached[0] != signature:
+            matches = search_names(self.get_lowercase_names(), text, mode)
+            cached = (signature, None if matches is None else set(matches))
+            search_results[key] = cached
+        return cached[1]
+
+    def get_search_error(self):
+        ''' Why the search can't be used, or None '''
+        text, mode = self.search
+        if not text:
+            return None
+        return search_error(text, mode)
+
+    def get_page(self, indexes):
+        ''' The part of indexes on the current page, the page and the number
+        of pages.  Only reads, so it's safe to call while drawing. '''
+        page_size = self.page_size
+        if page_size < 1 or len(indexes) <= page_size:
+            return indexes, 0, 1
+
+        num_pages = (len(indexes) - 1) // page_size + 1
+        page = max(0, min(self.page, num_pages - 1))
+        start = page * page_size
+        return indexes[start:start + page_size], page, num_pages
+
+    def turn_page(self, direction):
+        ''' Change the page.  direction is 'FIRST', 'PREVIOUS', 'NEXT',
+        'LAST' or 'ACTIVE', which jumps to the page with the active item. '''
+        indexes = self.get_visible_item_indexes()[0]
+        page_size = self.page_size
+        if page_size < 1 or len(indexes) <= page_size:
+            self.page = 0
+            return
+
+        num_pages = (len(indexes) - 1) // page_size + 1
+        page = max(0, min(self.page, num_pages - 1))
+        if direction == 'FIRST':
+            page = 0
+        elif direction == 'PREVIOUS':
+            page -= 1
+        elif direction == 'NEXT':
+            page += 1
+        elif direction == 'LAST':
+            page = num_pages - 1
+        elif direction == 'ACTIVE':
+            try:
+                page = indexes.index(self.active_item_index) // page_size
+            except ValueError:
+                pass
+        self.page = max(0, min(page, num_pages - 1))
+
     def copy_item(self, label_index):
         ''' Copies selected items to the given label index.
         Returns True if an item was added. '''
+        self.reconcile()
         label = self.labels[label_index]
+        if label.is_query:
+            return None
 
         # Get indexes
-        item_indexes = [i.index for i in label.indexes]
+        item_indexes = self.get_stored_indexes(label)
         selected = self.get_visible_item_indexes()[1]
 
         # Only add indexes that aren't already in that label
-        added_indexes = False
-        for i in selected:
-            if i not in item_indexes:
-                added_indexes = True
-                indexes = label.indexes.add()
-                indexes.index = i
+        existing = set(item_indexes)
+        added_indexes = [i for i in selected if i not in existing]
 
         if added_indexes:
+            item_indexes.extend(added_indexes)
+            self.set_stored_indexes(label, item_indexes)
+            self.invalidate_labels(label_index)
             return label.name
         return None
 
     def add_item(self, **add_items_kwargs):
+        self.reconcile()
         index = self.active_index
         labels = self.labels
 
         self.add_item_orig(**add_items_kwargs)
 
         # Add to current label if on is selected.
-        if index > 0:
+        if index > 0 and not labels[index].is_query:
             label = labels[index]
-            label_index = label.indexes.add()
-            label_index.index = self.active_item_index
+            label_indexes = self.get_stored_indexes(label)
+            label_indexes.append(self.active_item_index)
+            self.set_stored_indexes(label, label_indexes)
+            self.invalidate_labels(index)
 
         # Update "All" Label
 
         # Update selected
-        selected_items = self.selected_items
-        for x in range(len(selected_items)):
-            selected_items.remove(0)
-        selected_index = selected_items.add()
-        selected_index.index = self.active_item_index
+        self._store_selected([self.active_item_index])
+        self.update_fingerprint()
 
     def remove_item_index_from_label(self, index, label):
-        for x, i in enumerate(label.indexes):
-            if index == i.index:
-                label.indexes.remove(x)
-                break
+        label_indexes = self.get_stored_indexes(label)
+        if index in label_indexes:
+            label_indexes.remove(index)
+            self.set_stored_indexes(label, label_indexes)
 
     def remove_item(self):
         index = self.active_index
-        if index > 0:
+        if index > 0 and not self.labels[index].is_query:
             label = self.labels[index]
 
             # get selected
-            sel = self.get_visible_item_indexes()[1]
-            sel.sort()
-            sel.reverse()
-            for i in sel:
-                self.remove_item_index_from_label(i, label)
+            sel = set(self.get_visible_item_indexes()[1])
+            self.set_stored_indexes(label, [i for i in self.get_stored_indexes(label) if i not in sel])
+            self.invalidate_labels(index)
+
+    def _delete_items(self, indexes):
+        # Delete items one at a time through the original operator, then
+        # fix every label in one pass
+        num_items = len(self.items)
+        deleted = set(indexes)
+        for i in sorted(deleted, reverse=True):
+            self.active_item_index = i
+            self.remove_item_orig()
+
+        remap = []
+        kept = 0
+        for i in range(num_items):
+            if i in deleted:
+                remap.append(-1)
+            else:
+                remap.append(kept)
+                kept += 1
+        self.remap_items(remap)
 
     def _delete_active_item(self):
-        labels = self.labels
-        item_index = self.active_item_index
-        self.remove_item_orig()
-
-        if not labels:
-            return
-
-            if len(labels) > 1:
-                for x in range(1, len(labels)):
-                    self.remove_item_index_from_label(item_index, labels[x])
-
-                # Correct the moved index in every label (except the first label, All)
-                for x in range(1, len(labels)):
-                    label_indexes = labels[x].indexes
-                    for label_index in label_indexes:
-                        if label_index.index >= item_index:
-                            label_index.index -= 1
+        self._delete_items([self.active_item_index])
 
     def delete_item(self):
+        self.reconcile()
+
         # Delete selected
         sel = self.get_visible_item_indexes()[1]
         if sel:
-            sel.sort()
-            sel.reverse()
-            for i in sel:
-                self.active_item_index = i
-                self._delete_active_item()
+            self._delete_items(sel)
 
             # Update active index
             active_index = self.active_item_index
@@ -343,21 +1389,20 @@ class Blabels(object):
                 self.active_item_index = active_index + 1
 
             # Update selected
-            selected_items = self.selected_items
-            for sel in selected_items:
-                selected_items.remove(0)
-            s = selected_items.add()
-            s.index = self.active_item_index
+            self._store_selected([self.active_item_index])
+            self.update_fingerprint()
 
     def move_item(self, direction='up'):  # move_in_label(self):
+        self.reconcile()
         label_index = self.active_index
         labels = self.labels
 
         # Get indexes of visible keys
         indexes, sel = self.get_visible_item_indexes()
 
-        # If it's a real label
-        if label_index > 0:
+        # If it's a real label.  Query labels and labels with children move
+        # the items themselves, like All.
+        if label_index > 0 and not labels[label_index].is_query and not self.get_label_tree().children.get(label_index):
             # I'm sure there's a better way to do this.
 
             # Do everything in reverse if going down
@@ -397,9 +1442,17 @@ class Blabels(object):
             if direction.lower() != 'up':
                 new_indexes.reverse()
 
-            # Apply changes
-            for x, i in enumerate(new_indexes):
-                labels[label_index].indexes[x].index = i
+            # Apply changes.  The search and view mode may hide some of the
+            # label's items, so only the slots of the visible ones are
+            # reordered.
+            label = labels[label_index]
+            label_indexes = self.get_stored_indexes(label)
+            slots = {}
+            for x, i in enumerate(label_indexes):
+                slots.setdefault(i, x)
+            for x, i in zip(sorted(slots[i] for i in new_indexes if i in slots), new_indexes):
+                label_indexes[x] = i
+            self.set_stored_indexes(label, label_indexes)
         else:
             # Sort visible
             sel.sort()
@@ -412,17 +1465,25 @@ class Blabels(object):
 
             item_index = self.active_item_index
             new_item_index = -1
+            selected = set(self.get_selected())
+            # Every label is read and written once, however many items move
+            label_lists = [(label, self.get_stored_indexes(label)) for label in labels[1:]]
             for x, i in enumerate(sel):
                 # Only move down if it won't run into another selected item
                 if (i + increment) not in sel:
                     # Set active index, move shape key
                     self.active_item_index = i
-                    self.move_item_orig(self, direction=direction.upper())
+                    self.move_item_orig(direction=direction.upper())
                     new_index = self.active_item_index
 
-                    # Update actual selection
-                    selected_items = self.selected_items
-                    selected_items[x].index = new_index
+                    # Update actual selection.  The items swapped places.
+                    swapped = set()
+                    if i in selected:
+                        swapped.add(new_index)
+                    if new_index in selected:
+                        swapped.add(i)
+                    selected.difference_update((i, new_index))
+                    selected.update(swapped)
 
                     # Update selected items, so item clashes resolve correctly
                     sel[x] = new_index
@@ -432,53 +1493,190 @@ class Blabels(object):
                         new_item_index = new_index
 
                     # Correct the moved index in every label (except the first label, All)
-                    if len(labels) > 1:
-                        for y in range(1, len(labels)):
-                            label_indexes = labels[y].indexes
-                            for label_index in label_indexes:
-                                if label_index.index == i:
-                                    label_index.index = new_index
-                                elif label_index.index == new_index:
-                                    label_index.index = i
+                    for label, label_indexes in label_lists:
+                        for y, index in enumerate(label_indexes):
+                            if index == i:
+                                label_indexes[y] = new_index
+                            elif index == new_index:
+                                label_indexes[y] = i
             # Restore active_index
             if new_item_index > -1:
                 self.active_item_index = new_item_index
+            for label, label_indexes in label_lists:
+                self.set_stored_indexes(label, label_indexes)
+            self._store_selected(selected)
+            self.invalidate_labels()
+            self.update_fingerprint()
 
     def toggle_selected_item(self, inverse=False):  # toggle_selected(self):
-        selected_items = self.selected_items
         actual_indexes, actual_selected = self.get_visible_item_indexes(skip_view_mode_filter=True)
 
-        # Clean selected
-        for x in range(len(selected_items)):
-            selected_items.remove(0)
-
+        selected = []
         if inverse:
             # Select or de-select all
-            if len(actual_selected) >= 0 and len(actual_selected) != len(actual_indexes):
-                for i in actual_indexes:
-                    index = selected_items.add()
-                    index.index = i
+            if len(actual_selected) != len(actual_indexes):
+                selected = actual_indexes
         else:
             # Inverse selection
             actual_selected = set(actual_selected)
-            for i in actual_indexes:
-                if i not in actual_selected:
-                    index = selected_items.add()
-                    index.index = i
+            selected = [i for i in actual_indexes if i not in actual_selected]
 
         # Correct active index.  Correct for 0 selected.
-        selected = [i.index for i in selected_items]
         if selected:
-            if self.active_item_index not in selected:
+            if self.active_item_index not in set(selected):
                 self.active_item_index = selected[-1]
         else:
             self.active_item_index = 0
-            index = selected_items.add()
-            index.index = 0
+            selected = [0]
+        self._store_selected(selected)
 
     def label_index_updated(self):
         if self.labels and self.view_mode == 'UNLABELED' and self.active_index != 0:
             self.view_mode = 'ALL'
+        self.page = 0
+
+
+################################
+##    Validation - keeps labels valid outside of the draw code
+
+# Blabels subclasses to validate.  Panels add theirs when registering.
+validated_classes = []
+
+# (class name, object pointer) -> (item count, names checksum).  A change in
+# either means items were added, deleted, moved or renamed.
+item_signatures = {}
+
+
+def validate_object(blabels_class, obj, force=False):
+    if obj.type not in blabels_class.object_types:
+        return 0
+    label_accessor = blabels_class(bpy.context, obj)
+    if not label_accessor.labels:
+        return 0
+
+    signature = label_accessor._names_signature()
+    key = (blabels_class.__name__, obj.as_pointer())
+    if not force and item_signatures.get(key) == signature:
+        return 0
+    item_signatures[key] = signature
+    return label_accessor.validate()
+
+
+def validate_all(objects, force=False):
+    ''' Validate the labels of every object in objects.  Returns the number
+    of indexes dropped. '''
+    dropped = 0
+    for obj in objects:
+        for blabels_class in validated_classes:
+            dropped += validate_object(blabels_class, obj, force)
+    return dropped
+
+
+@persistent
+def validate_on_load(dummy):
+    # Pointers from the last file mean nothing now
+    item_signatures.clear()
+    selection_anchors.clear()
+    live_selections.clear()
+    clear_search_cache()
+    for obj in bpy.data.objects:
+        for blabels_class in validated_classes:
+            if obj.type in blabels_class.object_types:
+                blabels_class(bpy.context, obj).migrate_selection()
+    validate_all(bpy.data.objects, force=True)
+
+
+def remap_live_selections():
+    ''' Point the live selections at the same items, by name, after undo
+    restored an older item stack.  Selections that can't be matched are
+    dropped, falling back to the selection stored in the object. '''
+    classes = dict((blabels_class.__name__, blabels_class) for blabels_class in validated_classes)
+    for key, entry in list(live_selections.items()):
+        class_name, name = key
+        obj = bpy.data.objects.get(name)
+        blabels_class = classes.get(class_name)
+        if not obj or not blabels_class or obj.type not in blabels_class.object_types:
+            del live_selections[key]
+            continue
+        entry[2] = obj.as_pointer()
+
+        fingerprint = blabels_class(bpy.context, obj).fingerprint
+        if entry[1] == fingerprint:
+            continue
+        if not entry[1] or not fingerprint:
+            del live_selections[key]
+            continue
+        remap = diff_name_hashes(unpack_array('I', entry[1]), unpack_array('I', fingerprint))
+        indexes = ranges_to_indexes(unpack_array('i', entry[0]))
+        indexes = [remap[i] for i in indexes if i < len(remap) and remap[i] > -1]
+        entry[0] = pack_array('i', indexes_to_ranges(indexes))
+        entry[1] = fingerprint
+
+
+@persistent
+def validate_on_undo(dummy):
+    # Selecting items isn't undone, but the items may have moved
+    remap_live_selections()
+    selection_anchors.clear()
+    item_signatures.clear()
+    clear_search_cache()
+    obj = bpy.context.scene.objects.active
+    if obj:
+        validate_all([obj], force=True)
+
+
+@persistent
+def store_selections(dummy):
+    ''' Write the live selections to their objects, so they are saved '''
+    classes = dict((blabels_class.__name__, blabels_class) for blabels_class in validated_classes)
+    for (class_name, name), (data, fingerprint, pointer) in live_selections.items():
+        obj = bpy.data.objects.get(name)
+        blabels_class = classes.get(class_name)
+        if not obj or obj.as_pointer() != pointer or obj.library or not blabels_class or obj.type not in blabels_class.object_types:
+            continue
+        label_accessor = blabels_class(bpy.context, obj)
+        if label_accessor.stored_selection != data:
+            label_accessor.stored_selection = data
+
+
+@persistent
+def count_data_updates(scene):
+    # Shape key values and mutes tag the shape keys, vertex group locks and
+    # modifiers tag the object
+    global data_version
+    if bpy.data.objects.is_updated or bpy.data.shape_keys.is_updated:
+        data_version += 1
+
+
+@persistent
+def validate_on_update(scene):
+    # Runs very often, so only the active object is checked, and only
+    # validated when its signature changes.
+    obj = scene.objects.active
+    if obj and obj.mode != 'EDIT':
+        validate_all([obj])
+
+
+def register():
+    bpy.app.handlers.load_post.append(validate_on_load)
+    bpy.app.handlers.undo_post.append(validate_on_undo)
+    bpy.app.handlers.redo_post.append(validate_on_undo)
+    bpy.app.handlers.scene_update_post.append(count_data_updates)
+    bpy.app.handlers.scene_update_post.append(validate_on_update)
+    bpy.app.handlers.save_pre.append(store_selections)
+
+
+def unregister():
+    bpy.app.handlers.save_pre.remove(store_selections)
+    bpy.app.handlers.scene_update_post.remove(validate_on_update)
+    bpy.app.handlers.scene_update_post.remove(count_data_updates)
+    bpy.app.handlers.redo_post.remove(validate_on_undo)
+    bpy.app.handlers.undo_post.remove(validate_on_undo)
+    bpy.app.handlers.load_post.remove(validate_on_load)
+    item_signatures.clear()
+    selection_anchors.clear()
+    live_selections.clear()
+    clear_search_cache()
 
 
 # Taken from blender ui files.  Needed when Blabels is eventaully put into a UI class.
@@ -512,32 +1710,177 @@ class MeshButtonsPanel():
 #Shape_Key_Blabels().copy_item(14)
 # Shape_Key_Blabels().select_item(138)
 
+def draw_page_row(layout, operator, settings, page_size_prop, page, num_pages, num_items):
+    ''' Page buttons for a paged item list '''
+    row = layout.row(align=True)
+    row.scale_y = 0.8
+    row.operator(operator, icon='REW', text='').direction = 'FIRST'
+    row.operator(operator, icon='TRIA_LEFT', text='').direction = 'PREVIOUS'
+    row.label("%d / %d  (%d)" % (page + 1, num_pages, num_items))
+    row.operator(operator, icon='TRIA_RIGHT', text='').direction = 'NEXT'
+    row.operator(operator, icon='FF', text='').direction = 'LAST'
+    row.operator(operator, icon='PROP_ON', text='').direction = 'ACTIVE'
+    row.prop(settings, page_size_prop, text='')
+
+
+def draw_query_expression(layout, label_accessor, index):
+    ''' Expression field of a query label, with any error under it '''
+    label = label_accessor.labels[index]
+    layout.prop(label, 'query_expression', text="", icon='MOD_BOOLEAN')
+    if label.query_expression:
+        try:
+            label_accessor.check_query_expression(index)
+        except LabelExpressionError as err:
+            layout.label(str(err), icon='ERROR')
+
+
+def draw_search(layout, label_accessor, data, search_prop, mode_prop):
+    ''' Search field and mode, in red with the error under them if the
+    search can't be used '''
+    error = label_accessor.get_search_error()
+    row = layout.row(align=True)
+    row.alert = error is not None
+    row.prop(data, search_prop, text="", icon='VIEWZOOM')
+    row.prop(data, mode_prop, text="")
+    if error:
+        layout.label(error, icon='ERROR')
+
+
 class UI_UL_Blabels(UIList):
     @property
     def blabels_class(self):
         raise NotImplementedError
 
     def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
-        label = self.blabels_class(context).labels[index]
-        num_items = self.blabels_class(context).get_num_items(index)
+        label_accessor = self.blabels_class(context)
+        label = label_accessor.labels[index]
+        # Checked once for every row by filter_items
+        label_accessor._label_tree = drawn_trees.get(label_accessor._cache_key())
+        num_items = label_accessor.get_num_items(index)
         num_items = str(num_items)
 
+        # Indent children, with an expand toggle on parents
+        tree = label_accessor.get_label_tree()
+        if index > 0:
+            row = layout.row(align=True)
+            for x in range(tree.depth[index]):
+                row.label(icon='BLANK1')
+            if tree.children.get(index):
+                row.prop(label, 'expanded', text="", emboss=False, icon='TRIA_DOWN' if label.expanded else 'TRIA_RIGHT')
+            elif tree.depth[index]:
+                row.label(icon='BLANK1')
+            layout = row
+
         layout = layout.split(percentage=0.9)
-        layout.label(text=label.name, translate=False, icon_value=icon)
+        if label.is_query:
+            # Counted from the cached query results
+            layout.label(text=label.name, translate=False, icon='VIEWZOOM')
+        else:
+            layout.label(text=label.name, translate=False, icon_value=icon)
         layout.label(text=num_items)
         # if self.layout_type in {'DEFAULT', 'COMPACT'}:
         # elif self.layout_type in {'GRID'}:
             # layout.alignment = 'CENTER'
             # layout.label(text="", icon_value=icon)
 
+    def filter_items(self, context, data, propname):
+        # Tree order, hiding the children of collapsed labels
+        labels = getattr(data, propname)
+        label_accessor = self.blabels_class(context)
+        tree = label_accessor.get_label_tree()
+        drawn_trees[label_accessor._cache_key()] = tree
+
+        flags = [self.bitflag_filter_item] * len(labels)
+        order = [0] * len(labels)
+        hidden = set()
+        for position, x in enumerate(tree.order):
+            order[x] = position + 1
+            parent = tree.parent_of[x]
+            if parent in hidden or (parent and not labels[parent].expanded):
+                hidden.add(x)
+                flags[x] = 0
+        return flags, order
+
 
 class IndexProperty(bpy.types.PropertyGroup):
     index = bpy.props.IntProperty(default=-1)
 
 
+class LabelPose(bpy.types.PropertyGroup):
+    # Item names and values are packed with label_core, so a pose is three
+    # strings instead of thousands of rna items.
+    item_names = bpy.props.StringProperty()
+    values = bpy.props.StringProperty()
+    mutes = bpy.props.StringProperty()
+
+
+# Settings of query labels, saved with the label data
+QUERY_SETTINGS = ('query_expression', 'query_name', 'query_state', 'query_use_value', 'query_value_min', 'query_value_max',
+                  'query_vertex_group', 'query_armature')
+
+
 class IndexCollection(bpy.types.PropertyGroup):
     indexes = bpy.props.CollectionProperty(type=IndexProperty)
 
+    # Hierarchy.  uid is unique among an owner's labels, and stays the same
+    # when labels are moved.  parent_uid is 0 for top level labels.
+    uid = bpy.props.IntProperty(default=0, options={'HIDDEN'})
+    parent_uid = bpy.props.IntProperty(default=0, options={'HIDDEN'})
+    expanded = bpy.props.BoolProperty(name="Expanded", default=True, description="Show child labels")
+
+    # Query labels find their items instead of storing them.  Which
+    # settings are used depends on the kind of label.
+    is_query = bpy.props.BoolProperty(
+        name="Query",
+        default=False,
+        description="Fill the label from a query instead of by hand")
+    query_expression = bpy.props.StringProperty(
+        name="Expression",
+        description="Combine labels, eg. Mouth - Correctives.  | or + for union, & for intersection, - for difference, ^ for either but not both.  Quote names with spaces")
+    query_name = bpy.props.StringProperty(
+        name="Names",
+        description="Comma separated name patterns (eg. brow_*, *_L).  Start a pattern with ! to exclude names")
+    query_state = bpy.props.EnumProperty(
+        name="State",
+        items = (
+                    ('ANY', "Any", "Don't check muted or locked"),
+                    ('ON', "Muted / Locked", "Only muted shape keys or locked vertex groups"),
+                    ('OFF', "Not Muted / Unlocked", "Only unmuted shape keys or unlocked vertex groups"),
+               ),
+        default = 'ANY')
+    query_use_value = bpy.props.BoolProperty(
+        name="Value Range",
+        default=False,
+        description="Only shape keys with a value in the range")
+    query_value_min = bpy.props.FloatProperty(name="Min", default=0.001)
+    query_value_max = bpy.props.FloatProperty(name="Max", default=1.0)
+    query_vertex_group = bpy.props.StringProperty(
+        name="Vertex Group",
+        description="Only shape keys blended with this vertex group")
+    query_armature = bpy.props.EnumProperty(
+        name="Armature",
+        items = (
+                    ('ANY', "Any", "Don't check armatures"),
+                    ('IN', "Armature", "Only vertex groups of armature bones"),
+                    ('OUT', "Not Armature", "Only vertex groups that aren't armature bones"),
+               ),
+        default = 'ANY')
+
+    # Name patterns for label_core.compile_rules
+    rules = bpy.props.StringProperty(
+        name="Rules",
+        description="Comma separated name patterns (eg. brow_*, *_L).  Matching items are added to the label.  Start a pattern with ! to exclude names")
+    # Packed name hashes of the items already run through the rules, the
+    # rules they were run through, and the names they matched, see
+    # Blabels.apply_rules
+    rules_evaluated = bpy.props.StringProperty(options={'HIDDEN'})
+    rules_checked = bpy.props.StringProperty(options={'HIDDEN'})
+    rules_matched = bpy.props.StringProperty(options={'HIDDEN'})
+
+    # Only used by shape key labels
+    poses = bpy.props.CollectionProperty(type=LabelPose)
+    active_pose_index = bpy.props.IntProperty(default=0)
+
 # I wish I knew how to extend existing operators like object.shape_key_move
 # So I could override those with mine, and not risk my label state machine
 # becoming invalid if some other script/user calls object.shape_key_move
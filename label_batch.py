@@ -0,0 +1,299 @@
+''' Check and repair exported label files outside of Blender.
+
+Runs with a plain python (plus numpy), so it can chew through a whole asset
+library overnight:
+
+    python label_batch.py [-o OUTPUT] [-j JOBS] [--check] PATH [PATH ...]
+
+PATH may be label files (.json), shape key delta files (.blsk) or
+directories, which are searched recursively for both.  Each file is checked
+for out of range indexes, repeated indexes and empty labels.  Unless --check
+is given, repaired files are written to OUTPUT (keeping their path relative
+to the PATH they were found under), or over the originals with --in-place.
+Files without problems aren't rewritten.
+
+Like label_core and label_io, nothing in here may import bpy.
+'''
+'''
+*******************************************************************************
+    License and Copyright
+    Copyright 2012 Jordan Hueckstaedt
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+
+import numpy
+
+try:
+    from . import label_core
+    from . import label_io
+except (ImportError, ValueError):
+    # Run as a script, with the addon directory on the path
+    import label_core
+    import label_io
+
+BATCH_EXTENSIONS = ('.json', '.blsk')
+PROBLEMS = ('out_of_range', 'duplicates', 'empty')
+
+
+def new_result(path):
+    result = {'path': path, 'error': None, 'written': None}
+    result.update((problem, 0) for problem in PROBLEMS)
+    return result
+
+
+def repair_label_section(section, result, keep_empty=False):
+    ''' Repair one section of a label file in place, counting what was wrong
+    in result. '''
+    item_count = len(section.get('items', ()))
+    labels = section.get('labels') or []
+    active_name = None
+    active_label = section.get('active_label', 0)
+    if 0 <= active_label < len(labels):
+        active_name = labels[active_label].get('name')
+
+    # Parents may only be there to group their children
+    parents = set(label.get('parent') for label in labels if label.get('parent'))
+
+    repaired = []
+    for x, label in enumerate(labels):
+        if x == 0:
+            # "All" is always the first label, whatever it's called, and
+            # never stores indexes
+            if label.get('indexes'):
+                result['out_of_range'] += len(label['indexes'])
+            repaired.append(dict(label, name=label.get('name', 'All'), indexes=[]))
+            continue
+
+        indexes, out_of_range, duplicates = label_core.clean_indexes(label.get('indexes', ()), item_count)
+        result['out_of_range'] += out_of_range
+        result['duplicates'] += duplicates
+        if not indexes and not label.get('rules') and not label.get('query') and label.get('name') not in parents:
+            # Labels with rules may just have nothing matching yet, and
+            # query labels never store indexes
+            result['empty'] += 1
+            if not keep_empty:
+                continue
+        label = dict(label, indexes=indexes)
+        label.setdefault('name', "Label %d" % x)
+        repaired.append(label)
+
+    if not repaired:
+        repaired.append({'name': 'All', 'indexes': []})
+
+    section['labels'] = repaired
+    names = [label['name'] for label in repaired]
+    section['active_label'] = names.index(active_name) if active_name in names else 0
+
+
+def process_label_file(path, keep_empty=False):
+    ''' Check a label file.  Returns (result, repaired data). '''
+    result = new_result(path)
+    data = label_io.read_labels(path)
+    for section in label_io.LABEL_SECTIONS:
+        if section in data:
+            repair_label_section(data[section], result, keep_empty)
+    return result, data
+
+
+def process_delta_file(path):
+    ''' Check a shape key delta file.  Returns (result, (header, keys)), keys
+    being ready for label_io.write_shape_deltas.
+
+    A shape key that moves nothing is still a shape key, so keys without
+    deltas are counted as empty but kept. '''
+    result = new_result(path)
+    keys = []
+    with label_io.ShapeDeltaFile(path) as delta_file:
+        header = delta_file.header
+        vertex_count = delta_file.vertex_count
+        for key in delta_file.keys:
+            indexes, deltas = delta_file.read(key)
+
+            valid = indexes < vertex_count
+            result['out_of_range'] += int(len(indexes) - numpy.count_nonzero(valid))
+            indexes = indexes[valid]
+            deltas = deltas[valid]
+
+            # Keep the first delta written for each vertex
+            unique, first = numpy.unique(indexes, return_index=True)
+            if len(unique) != len(indexes):
+                result['duplicates'] += len(indexes) - len(unique)
+                first.sort()
+                indexes = indexes[first]
+                deltas = deltas[first]
+
+            if not len(indexes):
+                result['empty'] += 1
+            # Copy out of the memory map before it closes
+            keys.append((key, numpy.array(indexes), numpy.array(deltas)))
+    return result, (header, keys)
+
+
+def write_file(path, data):
+    ''' Write repaired data next to path first, so a failed write can't take
+    the original with it. '''
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    temp_path = path + '.tmp'
+    if path.endswith('.blsk'):
+        header, keys = data
+        label_io.write_shape_deltas(temp_path, header['label'], header['vertex_count'], keys,
+                                    dtype=header['dtype'], compress=header['compression'] == 'zlib')
+    else:
+        label_io.write_labels(temp_path, data)
+    os.replace(temp_path, path)
+
+
+def needs_repair(result, path):
+    if path.endswith('.blsk'):
+        # Empty keys are left alone
+        return bool(result['out_of_range'] or result['duplicates'])
+    return any(result[problem] for problem in PROBLEMS)
+
+
+def process_file(task):
+    ''' Worker entry point.  task is (path, output path or None, keep_empty). '''
+    path, output_path, keep_empty = task
+    try:
+        if path.endswith('.blsk'):
+            result, data = process_delta_file(path)
+        else:
+            result, data = process_label_file(path, keep_empty)
+        if output_path and needs_repair(result, path):
+            write_file(output_path, data)
+            result['written'] = output_path
+    except Exception as err:
+        # Anything can be wrong with a damaged file.  Report it and carry on
+        # with the rest.
+        result = new_result(path)
+        result['error'] = "%s: %s" % (type(err).__name__, err)
+    return result
+
+
+def find_files(paths):
+    ''' (path, path relative to the argument it was found under) for every
+    batch file under paths. '''
+    for root in paths:
+        if os.path.isdir(root):
+            for directory, dirnames, filenames in os.walk(root):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith(BATCH_EXTENSIONS):
+                        path = os.path.join(directory, filename)
+                        yield path, os.path.relpath(path, root)
+        else:
+            yield root, os.path.basename(root)
+
+
+def run(paths, output=None, in_place=False, jobs=None, keep_empty=False):
+    ''' Process every file under paths.  Returns the list of results. '''
+    tasks = []
+    for path, relative_path in find_files(paths):
+        if in_place:
+            output_path = path
+        elif output:
+            output_path = os.path.join(output, relative_path)
+        else:
+            output_path = None
+        tasks.append((path, output_path, keep_empty))
+
+    if jobs == 1 or len(tasks) < 2:
+        return [process_file(task) for task in tasks]
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # Small chunks keep the workers busy when file sizes vary a lot
+        chunksize = max(1, len(tasks) // ((jobs or multiprocessing.cpu_count()) * 8))
+        return list(pool.imap_unordered(process_file, tasks, chunksize))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def summarize(results):
+    summary = {'files': len(results), 'errors': 0, 'repaired': 0, 'clean': 0}
+    summary.update((problem, 0) for problem in PROBLEMS)
+    for result in results:
+        if result['error']:
+            summary['errors'] += 1
+            continue
+        for problem in PROBLEMS:
+            summary[problem] += result[problem]
+        if result['written']:
+            summary['repaired'] += 1
+        elif not any(result[problem] for problem in PROBLEMS):
+            summary['clean'] += 1
+    return summary
+
+
+def print_report(results, summary, verbose=False, stream=sys.stdout):
+    for result in sorted(results, key=lambda result: result['path']):
+        if result['error']:
+            stream.write("ERROR  %s: %s\n" % (result['path'], result['error']))
+        elif any(result[problem] for problem in PROBLEMS):
+            problems = ", ".join("%d %s" % (result[problem], problem.replace('_', ' ')) for problem in PROBLEMS if result[problem])
+            stream.write("%s  %s: %s\n" % ("FIXED" if result['written'] else "BAD  ", result['path'], problems))
+        elif verbose:
+            stream.write("OK     %s\n" % result['path'])
+
+    stream.write("\n%(files)d files: %(clean)d clean, %(repaired)d repaired, %(errors)d errors\n" % summary)
+    stream.write("%(out_of_range)d out of range indexes, %(duplicates)d duplicates, %(empty)d empty labels\n" % summary)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check and repair exported Blabels label and shape key delta files.")
+    parser.add_argument('paths', nargs='+', help="label files, delta files or directories")
+    parser.add_argument('-o', '--output', help="directory to write repaired files to")
+    parser.add_argument('--in-place', action='store_true', help="overwrite files that need repairs")
+    parser.add_argument('--check', action='store_true', help="only report problems, don't write anything")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="number of worker processes (default: one per cpu)")
+    parser.add_argument('--keep-empty', action='store_true', help="keep empty labels")
+    parser.add_argument('--report', help="also write the results to this json file")
+    parser.add_argument('-v', '--verbose', action='store_true', help="list files without problems too")
+    args = parser.parse_args(argv)
+
+    if args.output and args.in_place:
+        parser.error("--output and --in-place can't be used together")
+    if not args.check and not args.output and not args.in_place:
+        parser.error("give --output or --in-place, or --check to only report")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    output = None if args.check else args.output
+    in_place = args.in_place and not args.check
+    results = run(args.paths, output, in_place, args.jobs, args.keep_empty)
+    summary = summarize(results)
+    print_report(results, summary, args.verbose)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'summary': summary, 'files': results}, f, indent=1)
+
+    if summary['errors']:
+        return 2
+    if args.check and summary['files'] != summary['clean']:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,534 @@
+''' Pure python helpers for label data.
+
+Nothing in here may import bpy, so the label data can also be worked with
+outside of Blender. '''
+'''
+*******************************************************************************
+    License and Copyright
+    Copyright 2012 Jordan Hueckstaedt
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import base64
+import fnmatch
+import re
+import zlib
+from array import array
+
+
+def new_array(typecode, length):
+    ''' Zeroed array of the given length.  Handy as a foreach_get buffer. '''
+    return array(typecode, bytes(array(typecode).itemsize * length))
+
+
+def pack_array(typecode, values):
+    ''' Pack values into a base64 string, so they can be stored in a
+    StringProperty without one rna item per value. '''
+    if not isinstance(values, array) or values.typecode != typecode:
+        values = array(typecode, values)
+    return base64.b64encode(values.tobytes()).decode('ascii')
+
+
+def unpack_array(typecode, data):
+    ''' Inverse of pack_array '''
+    values = array(typecode)
+    if data:
+        values.frombytes(base64.b64decode(data.encode('ascii')))
+    return values
+
+
+def pack_names(names):
+    return '\n'.join(names)
+
+
+def unpack_names(data):
+    if not data:
+        return []
+    return data.split('\n')
+
+
+def split_combination_name(name, separator, names):
+    ''' Split a combination name like "A_B" into the names it's made of.
+
+    names is a set (or dict) of every valid name.  Names may contain the
+    separator themselves, so the split with the fewest parts wins.  Returns
+    None if the name can't be built from two or more names. '''
+    tokens = name.split(separator)
+    num_tokens = len(tokens)
+    if num_tokens < 2:
+        return None
+
+    # best[x] is the shortest list of names that makes up tokens[:x]
+    best = [None] * (num_tokens + 1)
+    best[0] = []
+    for end in range(1, num_tokens + 1):
+        for start in range(end):
+            if best[start] is None:
+                continue
+            part = separator.join(tokens[start:end])
+            if part == name or part not in names:
+                continue
+            if best[end] is None or len(best[start]) + 1 < len(best[end]):
+                best[end] = best[start] + [part]
+    return best[num_tokens]
+
+
+class DependencyGraph(object):
+    ''' Dependencies between items, eg. shape keys driving other shape keys.
+
+    dependencies maps an item index to the indexes it directly depends on.
+    duplicates holds (index, name) pairs for dependencies listed twice on
+    the same item. '''
+    def __init__(self, dependencies=None, duplicates=None):
+        self.dependencies = dependencies or {}
+        self.duplicates = duplicates or []
+        self._cycles = None
+
+    def __len__(self):
+        return len(self.dependencies)
+
+    def get_dependencies(self, index):
+        ''' Every index that index depends on, directly or not '''
+        found = set()
+        stack = list(self.dependencies.get(index, ()))
+        while stack:
+            i = stack.pop()
+            if i not in found:
+                found.add(i)
+                stack.extend(self.dependencies.get(i, ()))
+        found.discard(index)
+        return found
+
+    @property
+    def cycles(self):
+        ''' Lists of indexes that depend on each other in a loop '''
+        if self._cycles is None:
+            self._cycles = [c for c in self._strongly_connected() if len(c) > 1 or c[0] in self.dependencies.get(c[0], ())]
+        return self._cycles
+
+    def _strongly_connected(self):
+        # Iterative Tarjan, so deep driver chains can't hit the recursion limit.
+        dependencies = self.dependencies
+        order = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        components = []
+        counter = 0
+
+        for root in dependencies:
+            if root in order:
+                continue
+            work = [(root, iter(dependencies.get(root, ())))]
+            order[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in order:
+                        order[child] = low[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(dependencies.get(child, ()))))
+                        break
+                    elif child in on_stack:
+                        low[node] = min(low[node], order[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == order[node]:
+                        component = []
+                        while True:
+                            i = stack.pop()
+                            on_stack.discard(i)
+                            component.append(i)
+                            if i == node:
+                                break
+                        components.append(component)
+        return components
+
+    def get_depth(self):
+        ''' Length of the longest dependency chain.  Cycles count as one link. '''
+        components = self._strongly_connected()
+        component_of = {}
+        for x, component in enumerate(components):
+            for i in component:
+                component_of[i] = x
+
+        # Tarjan finds components in reverse topological order, so the depth
+        # of every dependency is known before the items that depend on it.
+        depth = []
+        for x, component in enumerate(components):
+            # A cycle is one link, even with nothing outside it
+            looped = len(component) > 1 or component[0] in self.dependencies.get(component[0], ())
+            level = 1 if looped else 0
+            for i in component:
+                for dependency in self.dependencies.get(i, ()):
+                    y = component_of.get(dependency)
+                    if y is None:
+                        level = max(level, 1)
+                    elif y != x:
+                        level = max(level, depth[y] + 1)
+            depth.append(level)
+        return max(depth) if depth else 0
+
+
+def remap_indexes(old_names, new_names):
+    ''' For each name in old_names, the index of the same name in new_names,
+    or -1.  One dictionary lookup per name. '''
+    lookup = dict((name, x) for x, name in enumerate(new_names))
+    return [lookup.get(name, -1) for name in old_names]
+
+
+def clean_indexes(indexes, length):
+    ''' indexes without out of range or repeated entries, in their original
+    order.  Returns (indexes, number out of range, number of duplicates). '''
+    seen = set()
+    cleaned = []
+    out_of_range = 0
+    for i in indexes:
+        if i < 0 or i >= length:
+            out_of_range += 1
+        elif i in seen:
+            continue
+        else:
+            seen.add(i)
+            cleaned.append(i)
+    duplicates = len(indexes) - len(cleaned) - out_of_range
+    return cleaned, out_of_range, duplicates
+
+
+def name_hashes(names):
+    ''' crc32 of each name, in order.  A compact fingerprint of a list of
+    names, see diff_name_hashes. '''
+    return array('I', [zlib.crc32(name.encode('utf-8')) for name in names])
+
+
+def names_checksum(names):
+    ''' One crc32 for a whole list of names.  Changes when any name does. '''
+    return zlib.crc32(pack_names(names).encode('utf-8'))
+
+
+def diff_name_hashes(old_hashes, new_hashes):
+    ''' For each index in old_hashes, its index in new_hashes, or -1 if it
+    was deleted.
+
+    Items are first matched by hash, which finds reorders, insertions and
+    deletions.  Unmatched items whose previous neighbour maps to the
+    previous neighbour in new_hashes are taken to be renamed. '''
+    # Positions of each hash, in reverse so pop() gives the first one
+    positions = {}
+    for x in reversed(range(len(new_hashes))):
+        positions.setdefault(new_hashes[x], []).append(x)
+
+    remap = [-1] * len(old_hashes)
+    matched = [False] * len(new_hashes)
+    for x, h in enumerate(old_hashes):
+        found = positions.get(h)
+        if found:
+            y = found.pop()
+            remap[x] = y
+            matched[y] = True
+
+    # Renames.  Going in order means runs of renamed items chain together.
+    num_new = len(new_hashes)
+    for x in range(len(old_hashes)):
+        if remap[x] > -1:
+            continue
+        if x == 0:
+            y = 0
+        elif remap[x - 1] > -1:
+            y = remap[x - 1] + 1
+        else:
+            continue
+        if y < num_new and not matched[y]:
+            remap[x] = y
+            matched[y] = True
+    return remap
+
+
+def search_names(names, text, mode='CONTAINS'):
+    ''' Indexes of the names matching text.  names must already be
+    lowercased.  mode is 'CONTAINS', 'PREFIX' or 'REGEX'.  Returns None if
+    text isn't a valid regular expression, see search_error. '''
+    if mode == 'REGEX':
+        try:
+            search = re.compile(text, re.IGNORECASE).search
+        except re.error:
+            return None
+        return [x for x, name in enumerate(names) if search(name)]
+
+    text = text.lower()
+    if mode == 'PREFIX':
+        return [x for x, name in enumerate(names) if name.startswith(text)]
+    return [x for x, name in enumerate(names) if text in name]
+
+
+def search_error(text, mode='CONTAINS'):
+    ''' Why search_names can't search for text, or None if it can '''
+    if mode == 'REGEX':
+        try:
+            re.compile(text, re.IGNORECASE)
+        except re.error as err:
+            return "Invalid expression: %s" % err
+    return None
+
+
+_compiled_rules = {}
+
+
+def compile_rules(rules):
+    ''' Compile label rules into a function that tests a name, or None if
+    there are no rules.
+
+    rules are comma separated fnmatch patterns, like "brow_*, *_L".  Patterns
+    starting with ! exclude names.  Matching is case sensitive.  Each rules
+    string is only compiled once. '''
+    try:
+        return _compiled_rules[rules]
+    except KeyError:
+        pass
+
+    include = []
+    exclude = []
+    for pattern in rules.split(','):
+        pattern = pattern.strip()
+        if pattern.startswith('!'):
+            if pattern[1:]:
+                exclude.append(fnmatch.translate(pattern[1:]))
+        elif pattern:
+            include.append(fnmatch.translate(pattern))
+
+    match = None
+    if include:
+        include_match = re.compile('|'.join(include)).match
+        if exclude:
+            exclude_match = re.compile('|'.join(exclude)).match
+            match = lambda name: bool(include_match(name)) and not exclude_match(name)
+        else:
+            match = lambda name: bool(include_match(name))
+    _compiled_rules[rules] = match
+    return match
+
+
+def indexes_to_ranges(indexes):
+    ''' Flat array('i') of [start, stop) pairs covering indexes.  A run of
+    neighbouring items costs two ints, however long it is. '''
+    ranges = array('i')
+    for i in sorted(set(indexes)):
+        if i < 0:
+            continue
+        if ranges and ranges[-1] == i:
+            ranges[-1] = i + 1
+        else:
+            ranges.append(i)
+            ranges.append(i + 1)
+    return ranges
+
+
+def ranges_to_indexes(ranges):
+    ''' Inverse of indexes_to_ranges.  The indexes come out sorted. '''
+    indexes = []
+    for x in range(0, len(ranges) - 1, 2):
+        indexes.extend(range(ranges[x], ranges[x + 1]))
+    return indexes
+
+
+################################
+##    Label expressions - set algebra over labels, using python ints as
+##    bitsets (bit i is item i)
+
+def indexes_to_bits(indexes):
+    data = bytearray()
+    for i in indexes:
+        byte = i >> 3
+        if byte >= len(data):
+            data.extend(bytes(byte + 1 - len(data)))
+        data[byte] |= 1 << (i & 7)
+    return int.from_bytes(bytes(data), 'little')
+
+
+def bits_to_indexes(bits):
+    binary = bin(bits)[:1:-1]
+    return [x for x, bit in enumerate(binary) if bit == '1']
+
+
+class LabelExpressionError(ValueError):
+    pass
+
+
+# A query label uses itself, directly or through other query labels
+class LabelCycleError(LabelExpressionError):
+    pass
+
+
+_expression_token = re.compile(r'''\s*(?:([()|&^+-])|"((?:[^"\\]|\\.)*)"|'([^']*)'|([^\s()|&^+\-"']+))''')
+_parsed_expressions = {}
+
+
+def parse_label_expression(text):
+    ''' Parse an expression like 'Mouth - "Lip Correctives"' into a tree of
+    ('label', name) and (operator, left, right) tuples.
+
+    Operators are | or + (union), & (intersection), - (difference) and ^
+    (in one but not both).  & binds tighter than the rest, which go left
+    to right.  Names with spaces or operators in them need quotes.  Parsed
+    expressions are cached. '''
+    try:
+        return _parsed_expressions[text]
+    except KeyError:
+        pass
+
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _expression_token.match(text, position)
+        if not match:
+            raise LabelExpressionError("Can't read %s" % text[position:].strip())
+        position = match.end()
+        operator, double_quoted, single_quoted, bare = match.groups()
+        if operator:
+            tokens.append(('op', operator))
+        elif double_quoted is not None:
+            tokens.append(('label', re.sub(r'\\(.)', r'\1', double_quoted)))
+        elif single_quoted is not None:
+            tokens.append(('label', single_quoted))
+        else:
+            tokens.append(('label', bare))
+    tokens.reverse()
+
+    def next_token():
+        return tokens[-1] if tokens else (None, None)
+
+    def parse_operand():
+        kind, value = next_token()
+        if kind == 'label':
+            tokens.pop()
+            return ('label', value)
+        if value == '(':
+            tokens.pop()
+            tree = parse_union()
+            if next_token()[1] != ')':
+                raise LabelExpressionError("Missing )")
+            tokens.pop()
+            return tree
+        raise LabelExpressionError("Expected a label name" + (" before %s" % value if value else ""))
+
+    def parse_intersection():
+        tree = parse_operand()
+        while next_token() == ('op', '&'):
+            tokens.pop()
+            tree = ('&', tree, parse_operand())
+        return tree
+
+    def parse_union():
+        tree = parse_intersection()
+        while next_token()[0] == 'op' and next_token()[1] in '|+-^':
+            operator = tokens.pop()[1]
+            if operator == '+':
+                operator = '|'
+            tree = (operator, tree, parse_intersection())
+        return tree
+
+    if not tokens:
+        raise LabelExpressionError("Empty expression")
+    tree = parse_union()
+    if tokens:
+        raise LabelExpressionError("Unexpected %s" % tokens[-1][1])
+    _parsed_expressions[text] = tree
+    return tree
+
+
+def evaluate_label_expression(tree, get_bits):
+    ''' Bitset of a parsed expression.  get_bits(name) returns the bitset of
+    a label. '''
+    if tree[0] == 'label':
+        return get_bits(tree[1])
+    operator, left, right = tree
+    left = evaluate_label_expression(left, get_bits)
+    right = evaluate_label_expression(right, get_bits)
+    if operator == '|':
+        return left | right
+    if operator == '&':
+        return left & right
+    if operator == '-':
+        return left & ~right
+    return left ^ right
+
+
+class LabelTree(object):
+    ''' Label hierarchy, built from each label's uid and parent uid.
+
+    Index 0 ("All") is the root.  Labels whose parent is missing, or whose
+    parents loop, hang off the root.  volatile holds the labels with a label
+    flagged in flags (eg. query labels) somewhere in their subtree. '''
+    def __init__(self, uids, parent_uids, flags=None):
+        index_of = dict((uid, x) for x, uid in enumerate(uids) if x > 0 and uid)
+        self.parent_of = {}
+        for x in range(1, len(uids)):
+            parent = index_of.get(parent_uids[x], 0)
+            self.parent_of[x] = 0 if parent == x else parent
+
+        # Break loops
+        for x in range(1, len(uids)):
+            seen = set([x])
+            parent = self.parent_of[x]
+            while parent:
+                if parent in seen:
+                    self.parent_of[x] = 0
+                    break
+                seen.add(parent)
+                parent = self.parent_of[parent]
+
+        self.children = {}
+        for x in range(1, len(uids)):
+            self.children.setdefault(self.parent_of[x], []).append(x)
+
+        # Depth first order, for drawing
+        self.order = []
+        self.depth = {0: -1}
+        stack = [0] if uids else []
+        while stack:
+            x = stack.pop()
+            if x:
+                self.depth[x] = self.depth[self.parent_of[x]] + 1
+                self.order.append(x)
+            stack.extend(reversed(self.children.get(x, ())))
+
+        self.volatile = set()
+        if flags is not None:
+            for x in reversed(self.order):
+                if flags[x] or any(child in self.volatile for child in self.children.get(x, ())):
+                    self.volatile.add(x)
+
+    def path_to_root(self, index):
+        ''' index and each of its parents, not including the root '''
+        while index:
+            yield index
+            index = self.parent_of[index]
+
+    def get_descendants(self, index):
+        found = []
+        stack = list(self.children.get(index, ()))
+        while stack:
+            x = stack.pop()
+            found.append(x)
+            stack.extend(self.children.get(x, ()))
+        return found
@@ -0,0 +1,265 @@
+''' Files for moving label data in and out of Blender.
+
+Like label_core, nothing in here may import bpy.
+
+Shape key delta files (.blsk)
+    Sparse shape key offsets for the keys in a label.  The layout is:
+
+        4 bytes     magic, b'BLSK'
+        uint16      format version
+        uint32      header size
+        header      utf-8 json, described below
+        blocks      one data block per shape key
+
+    All numbers are little endian.  The header holds:
+
+        label           name of the label the keys came from
+        vertex_count    number of vertices in the mesh
+        dtype           'float16' or 'float32', the type of the deltas
+        compression     'zlib' or 'none'
+        keys            list of shape keys, each with
+            name, relative_key, value, slider_min, slider_max, mute,
+            vertex_group    shape key settings
+            count           number of affected vertices
+            offset, size    position of the key's block, from the start of
+                            the blocks
+
+    A block holds count uint32 vertex indexes followed by count * 3 deltas,
+    compressed together if compression is 'zlib'.  Uncompressed blocks are
+    read straight out of a memory map.
+
+Label files (.json)
+    Label definitions, readable by any json parser:
+
+        {
+            "format": "blabels",
+            "version": 1,
+            "shape_keys": section,
+            "vertex_groups": section
+        }
+
+    Either section may be missing.  A section holds:
+
+        items           names of every shape key or vertex group, in order
+        labels          list of {"name": name, "indexes": [index, ...],
+                        "rules": rules, "query": settings, "parent": name},
+                        in label order.  Indexes point into items.  rules
+                        is optional, see label_core.compile_rules.  query
+                        is only there for query labels, which store no
+                        indexes.  parent is the name of the label's parent
+                        label, if it has one.  The first label is always
+                        "All", and has no indexes.
+        active_label    index of the active label
+        view_mode       view mode of the item list
+
+    Readers should match items by name, not index, since the items may have
+    changed since the file was written.
+'''
+'''
+*******************************************************************************
+    License and Copyright
+    Copyright 2012 Jordan Hueckstaedt
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import json
+import mmap
+import struct
+import zlib
+
+import numpy
+
+SHAPE_DELTA_MAGIC = b'BLSK'
+SHAPE_DELTA_VERSION = 1
+SHAPE_DELTA_KEY_SETTINGS = ('relative_key', 'value', 'slider_min', 'slider_max', 'mute', 'vertex_group')
+
+_prefix = struct.Struct('<4sHI')
+
+LABEL_FORMAT = 'blabels'
+LABEL_VERSION = 1
+LABEL_SECTIONS = ('shape_keys', 'vertex_groups')
+
+
+class LabelFileError(Exception):
+    pass
+
+
+def write_shape_deltas(path, label, vertex_count, keys, dtype='float32', compress=True):
+    ''' Write shape key deltas to a .blsk file.
+
+    keys is a list of (settings, indexes, deltas), where settings is a dict of
+    SHAPE_DELTA_KEY_SETTINGS plus name, indexes are the affected vertices and
+    deltas is an array of their offsets, shaped (len(indexes), 3). '''
+    if dtype not in ('float16', 'float32'):
+        raise ValueError("Unsupported delta type %s" % dtype)
+
+    blocks = []
+    header_keys = []
+    offset = 0
+    for settings, indexes, deltas in keys:
+        indexes = numpy.asarray(indexes, dtype='<u4')
+        deltas = numpy.asarray(deltas, dtype='<f4' if dtype == 'float32' else '<f2')
+        block = indexes.tobytes() + deltas.tobytes()
+        if compress:
+            block = zlib.compress(block)
+
+        key = dict((name, settings.get(name)) for name in SHAPE_DELTA_KEY_SETTINGS)
+        key.update(name=settings['name'], count=len(indexes), offset=offset, size=len(block))
+        header_keys.append(key)
+        blocks.append(block)
+        offset += len(block)
+
+    header = json.dumps({
+        'label': label,
+        'vertex_count': vertex_count,
+        'dtype': dtype,
+        'compression': 'zlib' if compress else 'none',
+        'keys': header_keys,
+        }).encode('utf-8')
+
+    with open(path, 'wb') as f:
+        f.write(_prefix.pack(SHAPE_DELTA_MAGIC, SHAPE_DELTA_VERSION, len(header)))
+        f.write(header)
+        for block in blocks:
+            f.write(block)
+
+
+class ShapeDeltaFile(object):
+    ''' Reads a .blsk file through a memory map.  Use it as a context manager:
+
+        with ShapeDeltaFile(path) as delta_file:
+            for key in delta_file.keys:
+                indexes, deltas = delta_file.read(key)
+
+    Arrays returned by read may point into the map, so use them before the
+    file is closed. '''
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            self._file.close()
+            raise LabelFileError("%s is empty" % path)
+
+        try:
+            magic, version, header_size = _prefix.unpack_from(self._map, 0)
+        except struct.error:
+            self.close()
+            raise LabelFileError("%s is not a shape key delta file" % path)
+        if magic != SHAPE_DELTA_MAGIC:
+            self.close()
+            raise LabelFileError("%s is not a shape key delta file" % path)
+        if version > SHAPE_DELTA_VERSION:
+            self.close()
+            raise LabelFileError("%s was written by a newer version (%d)" % (path, version))
+
+        start = _prefix.size
+        try:
+            self.header = json.loads(self._map[start:start + header_size].decode('utf-8'))
+        except ValueError:
+            self.close()
+            raise LabelFileError("%s has a damaged header" % path)
+        self._blocks = start + header_size
+        if not self._header_valid(len(self._map)):
+            self.close()
+            raise LabelFileError("%s has a damaged header" % path)
+
+    def _header_valid(self, size):
+        header = self.header
+        if not isinstance(header, dict) or not isinstance(header.get('keys'), list):
+            return False
+        if not isinstance(header.get('vertex_count'), int) or header['vertex_count'] < 0:
+            return False
+        if header.get('dtype') not in ('float16', 'float32') or header.get('compression') not in ('zlib', 'none'):
+            return False
+        for key in header['keys']:
+            if not isinstance(key, dict) or not isinstance(key.get('name'), str):
+                return False
+            for name in ('count', 'offset', 'size'):
+                if not isinstance(key.get(name), int) or key[name] < 0:
+                    return False
+            if self._blocks + key['offset'] + key['size'] > size:
+                return False
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Arrays from read still point into the map.  It's closed
+                # when they're garbage collected.
+                pass
+            self._map = None
+        self._file.close()
+
+    @property
+    def label(self):
+        return self.header['label']
+
+    @property
+    def vertex_count(self):
+        return self.header['vertex_count']
+
+    @property
+    def keys(self):
+        return self.header['keys']
+
+    def read(self, key):
+        ''' Affected vertex indexes and their float32 deltas, shaped (n, 3).
+        The indexes aren't checked against vertex_count. '''
+        start = self._blocks + key['offset']
+        block = memoryview(self._map)[start:start + key['size']]
+        count = key['count']
+        dtype = '<f4' if self.header['dtype'] == 'float32' else '<f2'
+        try:
+            if self.header['compression'] == 'zlib':
+                block = zlib.decompress(block)
+            indexes = numpy.frombuffer(block, dtype='<u4', count=count)
+            deltas = numpy.frombuffer(block, dtype=dtype, count=count * 3, offset=count * 4)
+        except (zlib.error, ValueError):
+            raise LabelFileError("%s: the data of %s is damaged" % (self.path, key['name']))
+        return indexes, deltas.reshape(-1, 3).astype(numpy.float32, copy=False)
+
+
+def write_labels(path, data):
+    ''' Write label definitions (see Label files above).  data holds the
+    sections. '''
+    data = dict(data)
+    data.update(format=LABEL_FORMAT, version=LABEL_VERSION)
+    with open(path, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+
+
+def read_labels(path):
+    ''' Read label definitions written by write_labels '''
+    with open(path, 'r') as f:
+        try:
+            data = json.load(f)
+        except ValueError:
+            raise LabelFileError("%s is not a label file" % path)
+
+    if not isinstance(data, dict) or data.get('format') != LABEL_FORMAT:
+        raise LabelFileError("%s is not a label file" % path)
+    if data.get('version', 0) > LABEL_VERSION:
+        raise LabelFileError("%s was written by a newer version (%d)" % (path, data['version']))
+    return data
@@ -0,0 +1,173 @@
+''' Operators that move labels between files and objects.
+
+Works on both shape key and vertex group labels.'''
+
+'''
+*******************************************************************************
+    License and Copyright
+    Copyright 2012 Jordan Hueckstaedt
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bpy
+from bpy_extras.io_utils import ExportHelper, ImportHelper
+from . import label_io
+from .shape_key_panel import Shape_Key_Blabels
+from .vertex_group_panel import Vertex_Group_Blables
+
+
+def get_label_accessors(context, shape_keys=True, vertex_groups=True):
+    ''' (label_io section name, Blabels) for each kind of label the active
+    object has. '''
+    obj = context.object
+    accessors = []
+    if shape_keys and obj.type == 'MESH':
+        accessors.append(('shape_keys', Shape_Key_Blabels(context)))
+    if vertex_groups:
+        accessors.append(('vertex_groups', Vertex_Group_Blables(context)))
+    return accessors
+
+
+def transfer_poll(context):
+    obj = context.object
+    return obj and obj.type in {'MESH', 'LATTICE', 'CURVE', 'SURFACE'}
+
+
+class ObjectLabelsExport(bpy.types.Operator, ExportHelper):
+    bl_idname = "object.labels_export"
+    bl_label = "Export Labels"
+    bl_description = "Export the active object's label definitions to a json file"
+
+    filename_ext = ".json"
+    filter_glob = bpy.props.StringProperty(default="*.json", options={'HIDDEN'})
+
+    use_shape_keys = bpy.props.BoolProperty(name="Shape Key Labels", default=True)
+    use_vertex_groups = bpy.props.BoolProperty(name="Vertex Group Labels", default=True)
+
+    @classmethod
+    def poll(cls, context):
+        return transfer_poll(context)
+
+    def execute(self, context):
+        data = {}
+        for section, label_accessor in get_label_accessors(context, self.use_shape_keys, self.use_vertex_groups):
+            data[section] = label_accessor.get_label_data()
+
+        label_io.write_labels(self.filepath, data)
+        return {'FINISHED'}
+
+
+class ObjectLabelsImport(bpy.types.Operator, ImportHelper):
+    bl_idname = "object.labels_import"
+    bl_label = "Import Labels"
+    bl_description = "Import label definitions from a json file.  Items are matched by name"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    filename_ext = ".json"
+    filter_glob = bpy.props.StringProperty(default="*.json", options={'HIDDEN'})
+
+    mode = bpy.props.EnumProperty(
+        name="Mode",
+        items = (
+                    ('REPLACE', "Replace", "Replace the existing labels"),
+                    ('MERGE', "Merge", "Add to the existing labels.  Labels with the same name are combined"),
+               ),
+        default = 'REPLACE'
+       )
+    use_shape_keys = bpy.props.BoolProperty(name="Shape Key Labels", default=True)
+    use_vertex_groups = bpy.props.BoolProperty(name="Vertex Group Labels", default=True)
+
+    @classmethod
+    def poll(cls, context):
+        return transfer_poll(context)
+
+    def execute(self, context):
+        try:
+            data = label_io.read_labels(self.filepath)
+        except (IOError, label_io.LabelFileError) as err:
+            self.report({'ERROR'}, str(err))
+            return {'CANCELLED'}
+
+        unmatched = []
+        for section, label_accessor in get_label_accessors(context, self.use_shape_keys, self.use_vertex_groups):
+            if section in data:
+                unmatched.extend(label_accessor.set_label_data(data[section], merge=self.mode == 'MERGE'))
+
+        if unmatched:
+            self.report({'WARNING'}, "%d labeled items weren't found: %s" % (len(unmatched), ", ".join(unmatched[:10])))
+        return {'FINISHED'}
+
+
+class ObjectLabelsCopyToSelected(bpy.types.Operator):
+    bl_idname = "object.labels_copy_to_selected"
+    bl_label = "Copy Labels to Selected"
+    bl_description = "Copy every label from the active object to the selected objects.  Items are matched by name"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    mode = bpy.props.EnumProperty(
+        name="Mode",
+        items = (
+                    ('REPLACE', "Replace", "Replace the existing labels"),
+                    ('MERGE', "Merge", "Add to the existing labels.  Labels with the same name are combined"),
+               ),
+        default = 'REPLACE'
+       )
+    use_shape_keys = bpy.props.BoolProperty(name="Shape Key Labels", default=True)
+    use_vertex_groups = bpy.props.BoolProperty(name="Vertex Group Labels", default=True)
+
+    @classmethod
+    def poll(cls, context):
+        return transfer_poll(context) and len(context.selected_objects) > 1
+
+    def execute(self, context):
+        source = context.object
+        data = {}
+        for section, label_accessor in get_label_accessors(context, self.use_shape_keys, self.use_vertex_groups):
+            data[section] = label_accessor.get_label_data()
+
+        # Shape key labels live on the mesh, so each mesh only needs them once.
+        meshes = set([source.data])
+        unmatched = []
+        for obj in context.selected_objects:
+            if obj == source or obj.type not in {'MESH', 'LATTICE', 'CURVE', 'SURFACE'}:
+                continue
+
+            missing = []
+            if 'shape_keys' in data and obj.type == 'MESH' and obj.data not in meshes:
+                meshes.add(obj.data)
+                missing.extend(Shape_Key_Blabels(context, obj).set_label_data(data['shape_keys'], merge=self.mode == 'MERGE'))
+            if 'vertex_groups' in data:
+                missing.extend(Vertex_Group_Blables(context, obj).set_label_data(data['vertex_groups'], merge=self.mode == 'MERGE'))
+            if missing:
+                unmatched.append("%s (%s)" % (obj.name, ", ".join(missing[:10])))
+
+        if unmatched:
+            self.report({'WARNING'}, "Unmatched items on %s" % "; ".join(unmatched))
+        return {'FINISHED'}
+
+
+def label_transfer_specials(self, context):
+    self.layout.operator("object.labels_export", text="Export Labels", icon='EXPORT')
+    self.layout.operator("object.labels_import", text="Import Labels", icon='IMPORT')
+    self.layout.operator("object.labels_copy_to_selected", text="Copy Labels to Selected", icon='COPYDOWN')
+
+
+def register():
+    bpy.types.MESH_MT_shape_key_specials.append(label_transfer_specials)
+    bpy.types.MESH_MT_vertex_group_specials.append(label_transfer_specials)
+
+
+def unregister():
+    bpy.types.MESH_MT_vertex_group_specials.remove(label_transfer_specials)
+    bpy.types.MESH_MT_shape_key_specials.remove(label_transfer_specials)
@@ -22,39 +22,50 @@ of other shape key related operations.'''
 '''
 
 import bpy
+import math
+import numpy
+import re
+from array import array
 from mathutils import Vector
 from bpy.types import Menu, Panel
+from bpy.app.handlers import persistent
+from bpy_extras.io_utils import ExportHelper, ImportHelper
 from .blabels import *
+from . import label_io
 
 
 class Shape_Key_Blabels(Blabels):
     @property
     def labels(self):
-        return self.context.object.data.shape_key_labels
+        return self.object.data.shape_key_labels
 
     @property
-    def selected_items(self):
-        return self.context.object.selected_shape_keys
+    def stored_selection(self):
+        return self.object.shape_key_selection
+
+    @stored_selection.setter
+    def stored_selection(self, data):
+        self.object.shape_key_selection = data
 
     @property
     def active_index(self):
-        return self.context.object.active_shape_key_label_index
+        return self.object.active_shape_key_label_index
 
     @active_index.setter
     def active_index(self, index):
-        self.context.object.active_shape_key_label_index = index
+        self.object.active_shape_key_label_index = index
 
     @property
     def active_item_index(self):
-        return self.context.object.active_shape_key_index
+        return self.object.active_shape_key_index
 
     @active_item_index.setter
     def active_item_index(self, index):
-        self.context.object.active_shape_key_index = index
+        self.object.active_shape_key_index = index
 
     @property
     def items(self):
-        obj = self.context.object
+        obj = self.object
         if obj.data.shape_keys:
             return obj.data.shape_keys.key_blocks
         else:
@@ -66,20 +77,72 @@ class Shape_Key_Blabels(Blabels):
 
     @view_mode.setter
     def view_mode(self, mode):
-        context.scene.shape_keys_view_mode = mode.upper()
+        self.context.scene.shape_keys_view_mode = mode.upper()
+
+    def evaluate_query(self, label):
+        items = self.items
+        indexes = range(len(items))
+
+        match = compile_rules(label.query_name)
+        if match:
+            names = self.get_item_names()
+            indexes = [i for i in indexes if match(names[i])]
+        if label.query_state != 'ANY':
+            mutes = self.get_cached_attribute('mute', 'b')
+            muted = label.query_state == 'ON'
+            indexes = [i for i in indexes if bool(mutes[i]) == muted]
+        if label.query_use_value:
+            values = self.get_cached_attribute('value')
+            low, high = label.query_value_min, label.query_value_max
+            indexes = [i for i in indexes if low <= values[i] <= high]
+        if label.query_vertex_group:
+            indexes = [i for i in indexes if items[i].vertex_group == label.query_vertex_group]
+        return indexes
+
+    @property
+    def search(self):
+        scene = self.context.scene
+        return scene.shape_keys_search, scene.shape_keys_search_mode
+
+    @property
+    def page(self):
+        return self.object.shape_key_page
+
+    @page.setter
+    def page(self, page):
+        self.object.shape_key_page = page
+
+    @property
+    def page_size(self):
+        return self.context.scene.shape_keys_page_size
+
+    @property
+    def fingerprint(self):
+        return self.object.data.shape_key_fingerprint
+
+    @fingerprint.setter
+    def fingerprint(self, data):
+        self.object.data.shape_key_fingerprint = data
+
+    object_types = {'MESH'}
+    legacy_selection = 'selected_shape_keys'
+
+    @property
+    def label_owner(self):
+        return self.object.data
 
     def add_item_orig(self, **add_item_kwargs):
         # add_item_kwargs: from_mix = self.from_mix
-        bpy.ops.object.shape_key_add(**add_item_kwargs)
+        self.call_operator(bpy.ops.object.shape_key_add, **add_item_kwargs)
 
     def remove_item_orig(self, **remove_item_kwargs):
-        bpy.ops.object.shape_key_remove(**remove_item_kwargs)
+        self.call_operator(bpy.ops.object.shape_key_remove, **remove_item_kwargs)
 
     def move_item_orig(self, **move_item_kwargs):
         # move_item_kwargs: type = self.type
         if 'direction' in move_item_kwargs:
             move_item_kwargs['type'] = move_item_kwargs.pop('direction')
-        bpy.ops.object.shape_key_move(**move_item_kwargs)
+        self.call_operator(bpy.ops.object.shape_key_move, **move_item_kwargs)
 
     def filter_view_mode(self, indexes, selected):
         # Filter "ALL" label by view mode
@@ -91,6 +154,12 @@ class Shape_Key_Blabels(Blabels):
         elif view_mode == 'HIDDEN':
             indexes = [i for i in indexes if items[i].mute]
             selected = [i for i in selected if i in indexes]
+        elif view_mode == 'DEPENDENCIES':
+            active = self.active_item_index
+            dependencies = get_driver_graph(self.object.data).get_dependencies(active)
+            dependencies.add(active)
+            indexes = [i for i in indexes if i in dependencies]
+            selected = [i for i in selected if i in dependencies]
 
         return indexes, selected
 
@@ -112,6 +181,337 @@ class Shape_Key_Blabels(Blabels):
             for i in indexes:
                 items[i].mute = not items[i].mute
 
+    def add_pose(self, use_mute=False):
+        ''' Store the values of the active label's shape keys as a new pose '''
+        label = self.active_label
+        items = self.items
+        indexes = self.get_label_indexes()
+        values = self.get_item_attribute('value')
+
+        pose = label.poses.add()
+        pose.name = "Pose %d" % len(label.poses)
+        pose.item_names = pack_names(items[i].name for i in indexes)
+        pose.values = pack_array('f', (values[i] for i in indexes))
+        if use_mute:
+            mutes = self.get_item_attribute('mute', 'b')
+            pose.mutes = pack_array('b', (mutes[i] for i in indexes))
+
+        label.active_pose_index = len(label.poses) - 1
+        return pose
+
+    def remove_pose(self, index):
+        label = self.active_label
+        if -1 < index < len(label.poses):
+            label.poses.remove(index)
+            label.active_pose_index = max(0, min(index, len(label.poses) - 1))
+
+    def get_pose_indexes(self, pose):
+        ''' Item indexes of the shape keys in a pose.  Keys are stored by name,
+        so poses survive keys being moved.  Missing keys are -1. '''
+        lookup = {key.name: x for x, key in enumerate(self.items)}
+        return [lookup.get(name, -1) for name in unpack_names(pose.item_names)]
+
+    def _pose_targets(self, pose, values, mutes):
+        # Overwrite values (and mutes) with the pose's stored state
+        indexes = self.get_pose_indexes(pose)
+        if values is not None:
+            for i, value in zip(indexes, unpack_array('f', pose.values)):
+                if i > -1:
+                    values[i] = value
+        if mutes is not None and pose.mutes:
+            for i, mute in zip(indexes, unpack_array('b', pose.mutes)):
+                if i > -1:
+                    mutes[i] = mute
+
+    def blend_poses(self, pose_a, pose_b, factor=1.0):
+        ''' Set shape key values to pose_a blended into pose_b by factor.
+        Passing None for pose_a blends from the current values.  Values are
+        written with one foreach_set. '''
+        current = self.get_item_attribute('value')
+        current_mutes = self.get_item_attribute('mute', 'b')
+
+        values_a = array('f', current)
+        mutes_a = array('b', current_mutes)
+        if pose_a is not None:
+            self._pose_targets(pose_a, values_a, mutes_a)
+
+        values_b = array('f', current)
+        mutes_b = array('b', current_mutes)
+        self._pose_targets(pose_b, values_b, mutes_b)
+
+        values = array('f', (a + (b - a) * factor for a, b in zip(values_a, values_b)))
+        self.set_item_attribute('value', values)
+
+        # Mute is on or off, so take it from whichever pose is closest.
+        mutes = mutes_b if factor >= 0.5 else mutes_a
+        if mutes != current_mutes:
+            self.set_item_attribute('mute', mutes)
+
+    def apply_pose(self, pose, factor=1.0):
+        self.blend_poses(None, pose, factor)
+
+    def get_animation_action(self, create=False):
+        ''' Action animating the shape key datablock '''
+        key = self.object.data.shape_keys
+        if key.animation_data is None:
+            if not create:
+                return None
+            key.animation_data_create()
+
+        action = key.animation_data.action
+        if action is None and create:
+            action = bpy.data.actions.new(key.name + "Action")
+            key.animation_data.action = action
+        return action
+
+    def sample_values(self, frames):
+        ''' Evaluated value of every shape key on each frame.  Returns one
+        array per frame, each read with a single foreach_get. '''
+        scene = self.context.scene
+        frame_current = scene.frame_current
+        samples = []
+        for frame in frames:
+            if frame != scene.frame_current:
+                scene.frame_set(frame)
+            samples.append(self.get_item_attribute('value'))
+        if scene.frame_current != frame_current:
+            scene.frame_set(frame_current)
+        return samples
+
+    def find_static_items(self, indexes, frames, tolerance=0.0001):
+        ''' Indexes of the shape keys whose value stays at zero on every frame.
+
+        Unanimated keys are checked against their current value and
+        animated keys against their keyframes.  Only driven keys, which can
+        depend on anything, have their values sampled frame by frame. '''
+        key = self.object.data.shape_keys
+        items = self.items
+        values = self.get_item_attribute('value')
+
+        drivers = set()
+        if key.animation_data:
+            drivers = {fcurve.data_path for fcurve in key.animation_data.drivers}
+        action = self.get_animation_action()
+        fcurves = {}
+        if action:
+            fcurves = {fcurve.data_path: fcurve for fcurve in action.fcurves}
+
+        static = []
+        driven = []
+        for i in indexes:
+            data_path = items[i].path_from_id('value')
+            if data_path in drivers:
+                driven.append(i)
+                continue
+
+            fcurve = fcurves.get(data_path)
+            if fcurve is None or fcurve.mute or not fcurve.keyframe_points:
+                if abs(values[i]) <= tolerance:
+                    static.append(i)
+            elif fcurve_is_zero(fcurve, frames, tolerance):
+                static.append(i)
+
+        if driven:
+            peaks = dict.fromkeys(driven, 0.0)
+            for sample in self.sample_values(frames):
+                for i in driven:
+                    value = abs(sample[i])
+                    if value > peaks[i]:
+                        peaks[i] = value
+            static.extend(i for i in driven if peaks[i] <= tolerance)
+            static.sort()
+        return static
+
+    @property
+    def mute_states(self):
+        return self.object.data.shape_key_mute_states
+
+    def push_mute_state(self, name):
+        ''' Save the mute state of every shape key on the mute state stack '''
+        state = self.mute_states.add()
+        state.name = name
+        state.item_names = pack_names(key.name for key in self.items)
+        state.mutes = pack_array('b', self.get_item_attribute('mute', 'b'))
+        return state
+
+    def pop_mute_state(self):
+        ''' Restore the last saved mute state with a single foreach_set.
+        Returns the name of the restored state. '''
+        states = self.mute_states
+        if not states:
+            return None
+
+        state = states[-1]
+        name = state.name
+        mutes = self.get_item_attribute('mute', 'b')
+        self._pose_targets(state, None, mutes)
+        self.set_item_attribute('mute', mutes)
+        states.remove(len(states) - 1)
+        return name
+
+    def solo_label(self, index=None):
+        ''' Mute every shape key outside of a label, saving the previous
+        state on the mute state stack. '''
+        label_indexes = set(self.get_label_indexes(index))
+        mutes = self.get_item_attribute('mute', 'b')
+        self.push_mute_state("Solo %s" % self.labels[self.active_index if index is None else index].name)
+
+        # Leave the reference key alone, and keep the label's own mute states.
+        for i in range(1, len(mutes)):
+            if i not in label_indexes:
+                mutes[i] = True
+        self.set_item_attribute('mute', mutes)
+
+    def mute_label(self, index=None):
+        ''' Mute every shape key in a label, saving the previous state on the
+        mute state stack. '''
+        mutes = self.get_item_attribute('mute', 'b')
+        self.push_mute_state("Mute %s" % self.labels[self.active_index if index is None else index].name)
+        for i in self.get_label_indexes(index):
+            if i != 0:
+                mutes[i] = True
+        self.set_item_attribute('mute', mutes)
+
+    def keyframe_items(self, indexes, frames):
+        ''' Key the value of the shape keys at indexes on every frame.
+
+        Every value is sampled with one foreach_get per frame, then each
+        fcurve is extended with a single keyframe_points.add and
+        foreach_set, instead of one keyframe_insert per key per frame. '''
+        items = self.items
+        if not indexes or not frames:
+            return
+
+        samples = self.sample_values(frames)
+        action = self.get_animation_action(create=True)
+        fcurves = {fcurve.data_path: fcurve for fcurve in action.fcurves}
+
+        for i in indexes:
+            data_path = items[i].path_from_id('value')
+            fcurve = fcurves.get(data_path)
+            if fcurve is None:
+                fcurve = action.fcurves.new(data_path)
+
+            keyframe_points = fcurve.keyframe_points
+            num_existing = len(keyframe_points)
+            co = new_array('f', num_existing * 2)
+            if num_existing:
+                keyframe_points.foreach_get('co', co)
+
+            # Overwrite keys already on a sampled frame, append the rest.
+            existing = {co[x]: x for x in range(0, len(co), 2)}
+            for frame, sample in zip(frames, samples):
+                x = existing.get(float(frame))
+                if x is None:
+                    co.append(frame)
+                    co.append(sample[i])
+                else:
+                    co[x + 1] = sample[i]
+
+            num_new = len(co) // 2 - num_existing
+            if num_new:
+                keyframe_points.add(num_new)
+            keyframe_points.foreach_set('co', co)
+            fcurve.update()
+
+    def export_deltas(self, path, dtype='float32', compress=True):
+        ''' Write the active label's shape keys to a sparse .blsk file.
+        Returns the number of shape keys written. '''
+        items = self.items
+        keys = []
+        for i in self.get_label_indexes():
+            if i == 0:
+                continue
+            key_block = items[i]
+            deltas = get_deltas(key_block)
+            affected = numpy.flatnonzero(numpy.abs(deltas).max(axis=1) > 0.0)
+            settings = {
+                'name': key_block.name,
+                'relative_key': key_block.relative_key.name,
+                'value': key_block.value,
+                'slider_min': key_block.slider_min,
+                'slider_max': key_block.slider_max,
+                'mute': key_block.mute,
+                'vertex_group': key_block.vertex_group,
+                }
+            keys.append((settings, affected, deltas[affected]))
+
+        label = self.active_label.name if self.labels else "All"
+        label_io.write_shape_deltas(path, label, len(items[0].data), keys, dtype=dtype, compress=compress)
+        return len(keys)
+
+    def import_deltas(self, path):
+        ''' Read a .blsk file into shape keys, replacing keys with the same
+        name, and restore its label.  Returns the number of shape keys read. '''
+        obj = self.object
+        with label_io.ShapeDeltaFile(path) as delta_file:
+            # Check everything before the mesh is touched, so a bad file
+            # leaves it alone
+            vertex_count = len(obj.data.vertices)
+            if delta_file.vertex_count != vertex_count:
+                raise label_io.LabelFileError("%s has %d vertices, %s has %d" % (
+                    path, delta_file.vertex_count, obj.name, vertex_count))
+            key_data = {}
+            for key in delta_file.keys:
+                indexes, deltas = delta_file.read(key)
+                if len(indexes) and int(indexes.max()) >= vertex_count:
+                    raise label_io.LabelFileError("%s moves vertex %d of %s, which only has %d vertices" % (
+                        key['name'], int(indexes.max()), obj.name, vertex_count))
+                key_data[key['name']] = indexes, deltas
+
+            if not obj.data.shape_keys:
+                obj.shape_key_add(name="Basis", from_mix=False)
+            items = self.items
+
+            # Create every key first, so relative keys in the file exist.
+            lookup = {key_block.name: x for x, key_block in enumerate(items)}
+            for key in delta_file.keys:
+                if key['name'] not in lookup:
+                    key_block = obj.shape_key_add(name=key['name'], from_mix=False)
+                    lookup[key_block.name] = len(items) - 1
+
+            # Keys relative to other keys in the file go after them.
+            pending = list(delta_file.keys)
+            file_names = set(key['name'] for key in pending)
+            done = set()
+            while pending:
+                ready = [key for key in pending if key['relative_key'] not in file_names or
+                         key['relative_key'] in done or key['relative_key'] == key['name']]
+                if not ready:
+                    # Relative keys in a loop.  Nothing sensible to do.
+                    ready = pending
+
+                for key in ready:
+                    key_block = items[lookup[key['name']]]
+                    relative = items[lookup.get(key['relative_key'], 0)]
+                    if relative != key_block:
+                        key_block.relative_key = relative
+
+                    indexes, deltas = key_data[key['name']]
+                    co = get_coordinates(relative)
+                    co[indexes] += deltas
+                    key_block.data.foreach_set('co', co.ravel())
+
+                    for setting in ('slider_min', 'slider_max', 'value', 'mute', 'vertex_group'):
+                        if key.get(setting) is not None:
+                            setattr(key_block, setting, key[setting])
+                    done.add(key['name'])
+                pending = [key for key in pending if key['name'] not in done]
+
+            indexes = [lookup[key['name']] for key in delta_file.keys]
+            if delta_file.label != "All":
+                self.active_index = self.set_label(delta_file.label, indexes)
+        obj.data.update()
+        return len(indexes)
+
+    def reset_pose(self, pose):
+        ''' Zero the values of every shape key in the pose '''
+        values = self.get_item_attribute('value')
+        for i in self.get_pose_indexes(pose):
+            if i > -1:
+                values[i] = 0.0
+        self.set_item_attribute('value', values)
+
 '''----------------------------------------------------------------------------
                             Label Helpers
 ----------------------------------------------------------------------------'''
@@ -143,6 +543,313 @@ def inline_vector_mult(vectorA, vectorB):
     return Vector([i * j for i, j in zip(vectorA, vectorB)])
 
 
+def fcurve_is_zero(fcurve, frames, tolerance):
+    ''' True if the fcurve stays within tolerance of zero on every frame '''
+    points = fcurve.keyframe_points
+    if not fcurve.modifiers:
+        # A curve segment never leaves the hull of its keys and handles, so
+        # if they're all zero, the whole curve is.
+        co = new_array('f', len(points) * 2)
+        peak = 0.0
+        for attr in ('co', 'handle_left', 'handle_right'):
+            points.foreach_get(attr, co)
+            peak = max(peak, max(abs(value) for value in co[1::2]))
+        if peak <= tolerance:
+            return True
+
+    # Non zero keys outside of the frame range can still leave it at zero.
+    return all(abs(fcurve.evaluate(frame)) <= tolerance for frame in frames)
+
+
+'''----------------------------------------------------------------------------
+                            Shape Key Data
+----------------------------------------------------------------------------'''
+
+
+def get_coordinates(key_block):
+    ''' Vertex positions of a shape key as an (n, 3) array '''
+    co = numpy.empty(len(key_block.data) * 3, dtype=numpy.float32)
+    key_block.data.foreach_get('co', co)
+    return co.reshape(-1, 3)
+
+
+def get_deltas(key_block):
+    ''' Offsets of a shape key from the key it's relative to '''
+    return get_coordinates(key_block) - get_coordinates(key_block.relative_key)
+
+
+# Vertex color layer the heatmap is written to
+heatmap_layer = "Blabels Heatmap"
+
+# Mesh pointer: {shape key name: coordinates, 'LOOPS': loop vertex indexes}
+heatmap_cache = {}
+heatmap_state = {}
+
+
+def write_heatmap(mesh, key_blocks, use_cache=False):
+    ''' Write the summed delta magnitude of key_blocks into a vertex color
+    layer, with one foreach_set.  use_cache keeps the coordinate arrays
+    around for the next call. '''
+    cache = {}
+    if use_cache:
+        cache = heatmap_cache.setdefault(mesh.as_pointer(), {})
+
+    def coordinates(key_block):
+        co = cache.get(key_block.name)
+        if co is None:
+            co = cache[key_block.name] = get_coordinates(key_block)
+        return co
+
+    deltas = numpy.zeros((len(mesh.vertices), 3), dtype=numpy.float32)
+    for key_block in key_blocks:
+        deltas += coordinates(key_block) - coordinates(key_block.relative_key)
+    magnitudes = numpy.sqrt((deltas ** 2).sum(axis=1))
+    peak = magnitudes.max() if len(magnitudes) else 0.0
+    if peak > 0.0:
+        magnitudes /= peak
+
+    loops = cache.get('LOOPS')
+    if loops is None:
+        loops = numpy.empty(len(mesh.loops), dtype=numpy.int32)
+        mesh.loops.foreach_get('vertex_index', loops)
+        cache['LOOPS'] = loops
+
+    layer = mesh.vertex_colors.get(heatmap_layer)
+    if layer is None:
+        layer = mesh.vertex_colors.new(heatmap_layer)
+    if not len(layer.data):
+        return
+
+    # Blue through green to red
+    heat = magnitudes[loops]
+    colors = numpy.ones((len(heat), len(layer.data[0].color)), dtype=numpy.float32)
+    colors[:, 0] = numpy.clip(heat * 2.0 - 1.0, 0.0, 1.0)
+    colors[:, 1] = 1.0 - numpy.abs(heat * 2.0 - 1.0)
+    colors[:, 2] = numpy.clip(1.0 - heat * 2.0, 0.0, 1.0)
+    layer.data.foreach_set('color', colors.ravel())
+    mesh.update()
+
+
+@persistent
+def heatmap_update(scene):
+    # Live heatmap.  Only rewritten when the active shape key changes.
+    if not scene.shape_key_heatmap_live:
+        return
+    obj = scene.objects.active
+    if not (obj and obj.type == 'MESH' and obj.mode != 'EDIT' and obj.data.shape_keys and obj.active_shape_key):
+        return
+
+    state = (obj.as_pointer(), obj.active_shape_key_index)
+    if heatmap_state.get('last') != state:
+        heatmap_state['last'] = state
+        write_heatmap(obj.data, [obj.active_shape_key], use_cache=True)
+
+
+def heatmap_live_updated(self, context):
+    # Coordinates may have been edited since they were cached.
+    heatmap_cache.clear()
+    heatmap_state.clear()
+
+
+# Near duplicate hashing.  Each table buckets keys by several random
+# projections of their deltas.
+lsh_tables = 4
+lsh_projections = 4
+
+
+def find_duplicate_shape_keys(shape_keys, indexes, tolerance):
+    ''' Group the shape keys whose deltas match within tolerance.
+
+    Every key is hashed once, instead of comparing every pair.  Exact
+    matches share a hash of their deltas quantized to tolerance.  Near
+    matches that quantize differently usually share a bucket of random
+    projections.  Only keys sharing a bucket are actually compared. '''
+    if len(indexes) < 2:
+        return []
+
+    size = len(shape_keys[indexes[0]].data) * 3
+    num_hashes = lsh_tables * lsh_projections
+    random = numpy.random.RandomState(0)
+    planes = random.standard_normal((size, num_hashes)).astype(numpy.float32)
+    offsets = random.uniform(0.0, 1.0, num_hashes)
+
+    # Keys within tolerance on every axis are at most tolerance * sqrt(size)
+    # apart, and so are their projections (give or take the normal spread).
+    width = 4.0 * tolerance * math.sqrt(size)
+
+    buckets = {}
+    for i in indexes:
+        deltas = get_deltas(shape_keys[i]).ravel()
+        quantized = numpy.round(deltas / tolerance).astype(numpy.int32)
+        buckets.setdefault(('QUANTIZED', quantized.tobytes()), []).append(i)
+
+        projected = numpy.floor(deltas.dot(planes) / width + offsets).astype(numpy.int64)
+        for table in range(lsh_tables):
+            bucket = projected[table * lsh_projections:(table + 1) * lsh_projections]
+            buckets.setdefault((table, bucket.tobytes()), []).append(i)
+
+    # Union find over confirmed matches
+    parent = {i: i for i in indexes}
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for members in buckets.values():
+        if len(members) < 2:
+            continue
+        # Members that matched nothing before them, with their deltas.  Each
+        # member is compared against every one, so two matches are found
+        # even when neither matches the first member.
+        representatives = [(members[0], None)]
+        for i in members[1:]:
+            deltas = None
+            for x, (representative, representative_deltas) in enumerate(representatives):
+                if find(i) == find(representative):
+                    break
+                if deltas is None:
+                    deltas = get_deltas(shape_keys[i])
+                if representative_deltas is None:
+                    representative_deltas = get_deltas(shape_keys[representative])
+                    representatives[x] = (representative, representative_deltas)
+                if numpy.abs(deltas - representative_deltas).max() <= tolerance:
+                    parent[find(i)] = find(representative)
+                    break
+            else:
+                representatives.append((i, deltas))
+
+    groups = {}
+    for i in indexes:
+        groups.setdefault(find(i), []).append(i)
+    return sorted(group for group in groups.values() if len(group) > 1)
+
+'''----------------------------------------------------------------------------
+                            Driver Graph
+----------------------------------------------------------------------------'''
+# Shape key paths, relative to either the mesh or the shape key datablock.
+# Quotes and backslashes in the name are escaped with a backslash.
+key_block_path = re.compile(r'^(?:shape_keys\.)?key_blocks\["(.+)"\]\.value$')
+path_escape = re.compile(r'\\(.)')
+
+
+def key_block_name(data_path):
+    # Name of the shape key whose value data_path points to, or None
+    match = key_block_path.match(data_path)
+    if match:
+        return path_escape.sub(r'\1', match.group(1))
+
+
+# Mesh pointer: (driver signature, DependencyGraph)
+driver_graphs = {}
+
+
+def driver_signature(keys):
+    # Cheap to gather compared to parsing every target.  Changes that keep
+    # the same signature are caught by invalidate_driver_graph.
+    if not keys or not keys.animation_data:
+        return ()
+    return tuple((fcurve.data_path, fcurve.driver.type,
+                  tuple((target.id.name if target.id else '', target.data_path)
+                        for var in fcurve.driver.variables for target in var.targets))
+                 for fcurve in keys.animation_data.drivers)
+
+
+def build_driver_graph(mesh):
+    ''' Walk the shape key drivers once and build a graph of which shape
+    keys drive which. '''
+    keys = mesh.shape_keys
+    dependencies = {}
+    duplicates = []
+    if not keys or not keys.animation_data:
+        return DependencyGraph()
+
+    lookup = {key.name: x for x, key in enumerate(keys.key_blocks)}
+    for fcurve in keys.animation_data.drivers:
+        name = key_block_name(fcurve.data_path)
+        if name not in lookup:
+            continue
+        index = lookup[name]
+
+        driving = dependencies.setdefault(index, [])
+        for var in fcurve.driver.variables:
+            for target in var.targets:
+                if target.id != mesh and target.id != keys:
+                    continue
+                name = key_block_name(target.data_path)
+                if name not in lookup:
+                    continue
+
+                dependency = lookup[name]
+                if dependency in driving:
+                    duplicates.append((index, var.name))
+                else:
+                    driving.append(dependency)
+    return DependencyGraph(dependencies, duplicates)
+
+
+def get_driver_graph(mesh, rebuild=False):
+    ''' Driver graph of a mesh's shape keys, cached until the drivers change '''
+    pointer = mesh.as_pointer()
+    signature = driver_signature(mesh.shape_keys)
+    cached = driver_graphs.get(pointer)
+    if rebuild or cached is None or cached[0] != signature:
+        cached = driver_graphs[pointer] = (signature, build_driver_graph(mesh))
+    return cached[1]
+
+
+def invalidate_driver_graph(mesh):
+    driver_graphs.pop(mesh.as_pointer(), None)
+
+
+def corrective_variable_path(key_block):
+    # path_from_id escapes the name
+    return 'shape_keys.' + key_block.path_from_id('value')
+
+
+def create_corrective_driver(mesh, index, driver_indexes, drivers=None):
+    ''' Drive the shape key at index with the MIN of the shape keys at
+    driver_indexes.
+
+    drivers optionally maps data paths to the existing driver fcurves.  If the
+    shape key already has this exact driver it's left alone and False is
+    returned. '''
+    keys = mesh.shape_keys
+    key_blocks = keys.key_blocks
+    driver_path = key_blocks[index].path_from_id('value')
+    driver_blocks = [key_blocks[i] for i in driver_indexes]
+
+    if drivers is not None:
+        fcurve = drivers.get(driver_path)
+        if fcurve is not None:
+            drv = fcurve.driver
+            current = [(var.name, var.targets[0].id, var.targets[0].data_path) for var in drv.variables]
+            wanted = [(key_block.name, mesh, corrective_variable_path(key_block)) for key_block in driver_blocks]
+            if drv.type == 'MIN' and current == wanted:
+                return False
+
+    # Create Driver
+    keys.driver_remove(driver_path)
+    fcurve = keys.driver_add(driver_path)
+    if drivers is not None:
+        drivers[driver_path] = fcurve
+
+    # Setup Driver
+    drv = fcurve.driver
+    drv.type = 'MIN'
+
+    for key_block in driver_blocks:
+        var = drv.variables.new()
+        var.name = key_block.name
+        var.targets[0].id_type = 'MESH'
+        var.targets[0].id = mesh
+        var.targets[0].data_path = corrective_variable_path(key_block)
+
+    invalidate_driver_graph(mesh)
+    return True
+
+
 def shape_keys_mute_others(shape_keys, selected_indexes):
     # Hide other shape keys and return their original states
     muted_states = []
@@ -184,25 +891,259 @@ class ShapeKeyCreateCorrective(bpy.types.Operator):
             active = sel.pop(-1)
         else:
             sel.remove(active)
-        keys = mesh.shape_keys
-        driver_path = 'key_blocks["%s"].value' % keys.key_blocks[active].name
+        create_corrective_driver(mesh, active, sel)
 
-        # Create Driver
-        keys.driver_remove(driver_path)
-        fcurve = keys.driver_add(driver_path)
+        return{'FINISHED'}
 
-        # Setup Driver
-        drv = fcurve.driver
-        drv.type = 'MIN'
 
-        for i in sel:
-            var = drv.variables.new()
-            var.name = keys.key_blocks[i].name
-            var.targets[0].id_type = 'MESH'
-            var.targets[0].id = mesh
-            var.targets[0].data_path = 'shape_keys.key_blocks["%s"].value' % var.name
+class ShapeKeyBatchCorrectives(bpy.types.Operator):
+    bl_idname = "object.shape_key_batch_correctives"
+    bl_label = "Create Corrective Drivers for Label"
+    bl_description = "Create corrective drivers for every combination shape key in the label.  A_B is driven by A and B"
+    bl_options = {'REGISTER', 'UNDO'}
 
-        return{'FINISHED'}
+    separator = bpy.props.StringProperty(
+        name="Separator",
+        default="_",
+        description="Separates the names of the driving shape keys in a combination shape key's name")
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_shapes=True, test_mode=False)
+
+    def execute(self, context):
+        if not self.separator:
+            self.report({'ERROR'}, "Separator can't be empty")
+            return {'CANCELLED'}
+
+        mesh = context.object.data
+        label_accessor = Shape_Key_Blabels(context)
+        shape_keys = label_accessor.items
+        indexes = label_accessor.get_visible_item_indexes()[0]
+
+        # Resolve every name through one lookup, and every existing driver
+        # through another.
+        lookup = {key.name: x for x, key in enumerate(shape_keys)}
+        drivers = {}
+        if mesh.shape_keys.animation_data:
+            drivers = {fcurve.data_path: fcurve for fcurve in mesh.shape_keys.animation_data.drivers}
+
+        created = skipped = 0
+        for i in indexes:
+            parts = split_combination_name(shape_keys[i].name, self.separator, lookup)
+            if parts is None:
+                continue
+            if create_corrective_driver(mesh, i, [lookup[part] for part in parts], drivers):
+                created += 1
+            else:
+                skipped += 1
+
+        self.report({'INFO'}, "Created %d corrective drivers, %d already up to date" % (created, skipped))
+        return {'FINISHED'}
+
+
+class ShapeKeyAnalyzeDrivers(bpy.types.Operator):
+    bl_idname = "object.shape_key_analyze_drivers"
+    bl_label = "Analyze Drivers"
+    bl_description = "Report the depth, cycles and duplicate variables of the shape key drivers, and select the problem keys"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_shapes=True, test_mode=False)
+
+    def execute(self, context):
+        graph = get_driver_graph(context.object.data, rebuild=True)
+        cycles = graph.cycles
+
+        problems = set(i for cycle in cycles for i in cycle)
+        problems.update(i for i, name in graph.duplicates)
+        if problems:
+            Shape_Key_Blabels(context).set_selected(sorted(problems))
+
+        self.report({'INFO'}, "%d driven shape keys, max depth %d, %d cycles, %d duplicate variables" % (
+            len(graph), graph.get_depth(), len(cycles), len(graph.duplicates)))
+        return {'FINISHED'}
+
+
+class ShapeKeyFindDuplicates(bpy.types.Operator):
+    bl_idname = "object.shape_key_find_duplicates"
+    bl_label = "Find Duplicate Shape Keys"
+    bl_description = "Put identical or nearly identical shape keys into a Duplicates label, and select all but the first of each"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    tolerance = bpy.props.FloatProperty(
+        name="Tolerance",
+        default=0.0001,
+        min=0.0000001,
+        precision=5,
+        description="Largest difference between two shape keys' vertex offsets that still counts as a duplicate")
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_shapes=True, test_mode=False)
+
+    def execute(self, context):
+        label_accessor = Shape_Key_Blabels(context)
+        shape_keys = label_accessor.items
+        indexes = [i for i in label_accessor.get_visible_item_indexes()[0] if i != 0]
+
+        groups = find_duplicate_shape_keys(shape_keys, indexes, self.tolerance)
+        if not groups:
+            self.report({'INFO'}, "No duplicate shape keys found")
+            return {'FINISHED'}
+
+        label_accessor.active_index = label_accessor.set_label("Duplicates", [i for group in groups for i in group])
+        extras = [i for group in groups for i in group[1:]]
+        label_accessor.set_selected(extras)
+
+        self.report({'INFO'}, "Found %d duplicate shape keys in %d groups" % (len(extras), len(groups)))
+        return {'FINISHED'}
+
+
+class ShapeKeyExtractVertexGroups(bpy.types.Operator):
+    bl_idname = "object.shape_key_extract_vertex_groups"
+    bl_label = "Affected Vertices to Vertex Groups"
+    bl_description = "Create or update a vertex group for each selected shape key, holding the vertices it moves"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    threshold = bpy.props.FloatProperty(
+        name="Threshold",
+        default=0.0001,
+        min=0.0,
+        precision=5,
+        description="Vertices that move less than this are left out")
+    use_weights = bpy.props.BoolProperty(
+        name="Weight by Distance",
+        default=False,
+        description="Weight vertices by how far they move, relative to the vertex that moves the most")
+    weight_steps = bpy.props.IntProperty(
+        name="Weight Steps",
+        default=20,
+        min=1,
+        max=1000,
+        description="Weights are rounded up to this many steps, so they can be written a step at a time")
+    prefix = bpy.props.StringProperty(
+        name="Prefix",
+        default="",
+        description="Added to the start of each vertex group name")
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_shapes=True) and context.object.type == 'MESH'
+
+    def execute(self, context):
+        obj = context.object
+        label_accessor = Shape_Key_Blabels(context)
+        shape_keys = label_accessor.items
+        selected = [i for i in label_accessor.get_visible_item_indexes()[1] if i != 0]
+        all_vertices = list(range(len(obj.data.vertices)))
+
+        for i in selected:
+            magnitudes = numpy.sqrt((get_deltas(shape_keys[i]) ** 2).sum(axis=1))
+            affected = numpy.flatnonzero(magnitudes > self.threshold)
+
+            name = self.prefix + shape_keys[i].name
+            group = obj.vertex_groups.get(name)
+            if group is None:
+                group = obj.vertex_groups.new(name)
+            else:
+                group.remove(all_vertices)
+
+            if not len(affected):
+                continue
+
+            if self.use_weights:
+                # Round weights up to a step, so every vertex on a step goes
+                # in with one add call.
+                steps = numpy.ceil(magnitudes[affected] / magnitudes[affected].max() * self.weight_steps)
+                for step in numpy.unique(steps):
+                    group.add(affected[steps == step].tolist(), float(step) / self.weight_steps, 'REPLACE')
+            else:
+                group.add(affected.tolist(), 1.0, 'REPLACE')
+
+        self.report({'INFO'}, "Updated %d vertex groups" % len(selected))
+        return {'FINISHED'}
+
+
+class ShapeKeyHeatmap(bpy.types.Operator):
+    bl_idname = "object.shape_key_heatmap"
+    bl_label = "Shape Key Heatmap"
+    bl_description = "Color vertices by how far the selected shape keys move them"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    selected = bpy.props.BoolProperty(
+        name="Sum Selected",
+        default=True,
+        description="Sum every selected shape key.  Otherwise only the active shape key is used")
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_shapes=True) and context.object.type == 'MESH'
+
+    def execute(self, context):
+        obj = context.object
+        label_accessor = Shape_Key_Blabels(context)
+        shape_keys = label_accessor.items
+        if self.selected:
+            key_blocks = [shape_keys[i] for i in label_accessor.get_visible_item_indexes()[1]]
+        else:
+            key_blocks = [obj.active_shape_key]
+
+        heatmap_cache.pop(obj.data.as_pointer(), None)
+        write_heatmap(obj.data, key_blocks)
+        return {'FINISHED'}
+
+
+class ShapeKeyExportLabel(bpy.types.Operator, ExportHelper):
+    bl_idname = "object.shape_key_export_label"
+    bl_label = "Export Label Shape Keys"
+    bl_description = "Export the shape keys in the active label to a compact file"
+
+    filename_ext = ".blsk"
+    filter_glob = bpy.props.StringProperty(default="*.blsk", options={'HIDDEN'})
+
+    use_float16 = bpy.props.BoolProperty(
+        name="Half Precision",
+        default=False,
+        description="Store offsets as 16 bit floats.  Half the size, but less accurate")
+    use_compression = bpy.props.BoolProperty(
+        name="Compress",
+        default=True,
+        description="Compress the offsets with zlib")
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_shapes=True)
+
+    def execute(self, context):
+        dtype = 'float16' if self.use_float16 else 'float32'
+        count = Shape_Key_Blabels(context).export_deltas(self.filepath, dtype=dtype, compress=self.use_compression)
+        self.report({'INFO'}, "Exported %d shape keys" % count)
+        return {'FINISHED'}
+
+
+class ShapeKeyImportLabel(bpy.types.Operator, ImportHelper):
+    bl_idname = "object.shape_key_import_label"
+    bl_label = "Import Label Shape Keys"
+    bl_description = "Import shape keys and their label from a compact file"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    filename_ext = ".blsk"
+    filter_glob = bpy.props.StringProperty(default="*.blsk", options={'HIDDEN'})
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context) and context.object.type == 'MESH'
+
+    def execute(self, context):
+        try:
+            count = Shape_Key_Blabels(context).import_deltas(self.filepath)
+        except (IOError, label_io.LabelFileError) as err:
+            self.report({'ERROR'}, str(err))
+            return {'CANCELLED'}
+        self.report({'INFO'}, "Imported %d shape keys" % count)
+        return {'FINISHED'}
 
 
 class ShapeKeyAxis(bpy.types.Operator):
@@ -473,6 +1414,259 @@ class ShapeKeyScrubTwo(bpy.types.Operator):
             shape_keys[selected[1]].value = 1.0 - self.percent
         return {'FINISHED'}
 
+
+def pose_poll(context, test_poses=True):
+    # Poses need shape keys and a label to live on.
+    if not label_poll(context, test_shapes=True, test_mode=False):
+        return False
+
+    label_accessor = Shape_Key_Blabels(context)
+    if not label_accessor.labels:
+        return False
+    if test_poses:
+        return bool(label_accessor.active_label.poses)
+    return True
+
+
+class ShapeKeyPoseAdd(bpy.types.Operator):
+    bl_idname = "object.shape_key_pose_add"
+    bl_label = "Add Pose"
+    bl_description = "Store the values of the shape keys in the active label as a pose"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    use_mute = bpy.props.BoolProperty(
+        name="Store Mute",
+        default=False,
+        description="Also store the mute state of the shape keys")
+
+    @classmethod
+    def poll(cls, context):
+        return pose_poll(context, test_poses=False)
+
+    def execute(self, context):
+        Shape_Key_Blabels(context).add_pose(use_mute=self.use_mute)
+        return {'FINISHED'}
+
+
+class ShapeKeyPoseRemove(bpy.types.Operator):
+    bl_idname = "object.shape_key_pose_remove"
+    bl_label = "Remove Pose"
+    bl_description = "Remove the active pose"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return pose_poll(context)
+
+    def execute(self, context):
+        label_accessor = Shape_Key_Blabels(context)
+        label_accessor.remove_pose(label_accessor.active_label.active_pose_index)
+        return {'FINISHED'}
+
+
+class ShapeKeyPoseApply(bpy.types.Operator):
+    bl_idname = "object.shape_key_pose_apply"
+    bl_label = "Apply Pose"
+    bl_description = "Set the shape keys in the active pose to their stored values"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    factor = bpy.props.FloatProperty(
+        name="Factor",
+        default=1.0,
+        soft_min=0,
+        soft_max=1,
+        subtype='FACTOR')
+
+    @classmethod
+    def poll(cls, context):
+        return pose_poll(context)
+
+    def execute(self, context):
+        label_accessor = Shape_Key_Blabels(context)
+        label = label_accessor.active_label
+        if label.active_pose_index < len(label.poses):
+            label_accessor.apply_pose(label.poses[label.active_pose_index], self.factor)
+        return {'FINISHED'}
+
+
+class ShapeKeyPoseBlend(bpy.types.Operator):
+    bl_idname = "object.shape_key_pose_blend"
+    bl_label = "Blend Poses"
+    bl_description = "Blend between the active pose and another pose"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    index = bpy.props.IntProperty(default=-1)
+    factor = bpy.props.FloatProperty(
+        name="Factor",
+        default=0.5,
+        soft_min=0,
+        soft_max=1,
+        subtype='FACTOR')
+
+    @classmethod
+    def poll(cls, context):
+        return pose_poll(context)
+
+    def execute(self, context):
+        label_accessor = Shape_Key_Blabels(context)
+        label = label_accessor.active_label
+        poses = label.poses
+        if -1 < self.index < len(poses) and label.active_pose_index < len(poses):
+            label_accessor.blend_poses(poses[label.active_pose_index], poses[self.index], self.factor)
+        return {'FINISHED'}
+
+
+class ShapeKeyPoseReset(bpy.types.Operator):
+    bl_idname = "object.shape_key_pose_reset"
+    bl_label = "Reset Pose"
+    bl_description = "Zero the shape keys in the active pose"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return pose_poll(context)
+
+    def execute(self, context):
+        label_accessor = Shape_Key_Blabels(context)
+        label = label_accessor.active_label
+        if label.active_pose_index < len(label.poses):
+            label_accessor.reset_pose(label.poses[label.active_pose_index])
+        return {'FINISHED'}
+
+class ShapeKeyKeyframeLabel(bpy.types.Operator):
+    bl_idname = "object.shape_key_keyframe_label"
+    bl_label = "Keyframe Label"
+    bl_description = "Keyframe the value of every shape key in the label over a frame range"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    frame_start = bpy.props.IntProperty(name="Start Frame", default=1)
+    frame_end = bpy.props.IntProperty(name="End Frame", default=250)
+    frame_step = bpy.props.IntProperty(name="Frame Step", default=1, min=1)
+    selected = bpy.props.BoolProperty(
+        name="Only Selected",
+        default=False,
+        description="Only keyframe the selected shape keys")
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_shapes=True)
+
+    def invoke(self, context, event):
+        scene = context.scene
+        if scene.use_preview_range:
+            self.frame_start = scene.frame_preview_start
+            self.frame_end = scene.frame_preview_end
+        else:
+            self.frame_start = scene.frame_start
+            self.frame_end = scene.frame_end
+        return context.window_manager.invoke_props_dialog(self)
+
+    def execute(self, context):
+        label_accessor = Shape_Key_Blabels(context)
+        indexes, selected = label_accessor.get_visible_item_indexes()
+        if self.selected:
+            indexes = selected
+
+        frames = list(range(self.frame_start, self.frame_end + 1, self.frame_step))
+        label_accessor.keyframe_items(indexes, frames)
+        self.report({'INFO'}, "Keyed %d shape keys on %d frames" % (len(indexes), len(frames)))
+        return {'FINISHED'}
+
+class ShapeKeyMuteStatic(bpy.types.Operator):
+    bl_idname = "object.shape_key_mute_static"
+    bl_label = "Mute Static Shape Keys"
+    bl_description = "Find the shape keys in the label that stay at zero for the whole animation, and mute them"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    frame_step = bpy.props.IntProperty(name="Frame Step", default=1, min=1)
+    tolerance = bpy.props.FloatProperty(name="Tolerance", default=0.0001, min=0.0, precision=5)
+    mute = bpy.props.BoolProperty(
+        name="Mute",
+        default=True,
+        description="Mute the static shape keys.  Otherwise they are only selected")
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_shapes=True, test_mode=False)
+
+    def execute(self, context):
+        scene = context.scene
+        label_accessor = Shape_Key_Blabels(context)
+
+        # The reference key is never evaluated, so leave it alone.
+        indexes = [i for i in label_accessor.get_visible_item_indexes()[0] if i != 0]
+        frames = list(range(scene.frame_start, scene.frame_end + 1, self.frame_step))
+        static = label_accessor.find_static_items(indexes, frames, self.tolerance)
+
+        if not static:
+            self.report({'INFO'}, "No static shape keys found")
+            return {'FINISHED'}
+
+        label_accessor.set_selected(static)
+        if self.mute:
+            label_accessor.push_mute_state("Mute Static")
+            mutes = label_accessor.get_item_attribute('mute', 'b')
+            for i in static:
+                mutes[i] = True
+            label_accessor.set_item_attribute('mute', mutes)
+            self.report({'INFO'}, "Muted %d static shape keys" % len(static))
+        else:
+            self.report({'INFO'}, "Selected %d static shape keys" % len(static))
+        return {'FINISHED'}
+
+
+class ShapeKeySoloLabel(bpy.types.Operator):
+    bl_idname = "object.shape_key_solo_label"
+    bl_label = "Solo Label"
+    bl_description = "Mute every shape key outside of the active label.  Restore Mute State undoes it"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        if not label_poll(context, test_shapes=True, test_mode=False):
+            return False
+        return bool(context.object.data.shape_key_labels)
+
+    def execute(self, context):
+        Shape_Key_Blabels(context).solo_label()
+        return {'FINISHED'}
+
+
+class ShapeKeyMuteLabel(bpy.types.Operator):
+    bl_idname = "object.shape_key_mute_label"
+    bl_label = "Mute Label"
+    bl_description = "Mute every shape key in the active label.  Restore Mute State undoes it"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        if not label_poll(context, test_shapes=True, test_mode=False):
+            return False
+        return bool(context.object.data.shape_key_labels)
+
+    def execute(self, context):
+        Shape_Key_Blabels(context).mute_label()
+        return {'FINISHED'}
+
+
+class ShapeKeyRestoreMute(bpy.types.Operator):
+    bl_idname = "object.shape_key_restore_mute"
+    bl_label = "Restore Mute State"
+    bl_description = "Restore the shape key mute state saved before the last mute operation"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        if not label_poll(context, test_shapes=True, test_mode=False):
+            return False
+        return bool(context.object.data.shape_key_mute_states)
+
+    def execute(self, context):
+        name = Shape_Key_Blabels(context).pop_mute_state()
+        if name is not None:
+            self.report({'INFO'}, "Restored %s" % name)
+        return {'FINISHED'}
+
 '''----------------------------------------------------------------------------
                             Label Operators
 ----------------------------------------------------------------------------'''
@@ -484,12 +1678,17 @@ class ShapeKeyLabelAdd(bpy.types.Operator):
     bl_description = "Add Label"
     bl_options = {'REGISTER', 'UNDO'}
 
+    all_selected = all_selected_property()
+
     @classmethod
     def poll(cls, context):
         return label_poll(context, test_mode=False)
 
     def execute(self, context):
-        Shape_Key_Blabels(context).add()
+        # Give every object's new label the same name
+        name = "Label %d" % len(Shape_Key_Blabels(context).labels)
+        for_each_label_object(context, Shape_Key_Blabels, lambda label_accessor: label_accessor.add(name),
+                              self.all_selected, match_label=False)
         return {'FINISHED'}
 
 
@@ -499,12 +1698,14 @@ class ShapeKeyLabelRemove(bpy.types.Operator):
     bl_description = "Remove Label"
     bl_options = {'REGISTER', 'UNDO'}
 
+    all_selected = all_selected_property()
+
     @classmethod
     def poll(cls, context):
         return label_poll(context, test_mode=False)
 
     def execute(self, context):
-        Shape_Key_Blabels(context).remove()
+        for_each_label_object(context, Shape_Key_Blabels, lambda label_accessor: label_accessor.remove(), self.all_selected)
         return {'FINISHED'}
 
 
@@ -522,24 +1723,52 @@ class ShapeKeyLabelMove(bpy.types.Operator):
                 ),
         default = 'UP'
         )
+    all_selected = all_selected_property()
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_mode=False)
+
+    def execute(self, context):
+        for_each_label_object(context, Shape_Key_Blabels,
+                              lambda label_accessor: label_accessor.move(direction=self.type), self.all_selected)
+        return {'FINISHED'}
+
+
+class ShapeKeyLabelParent(bpy.types.Operator):
+    bl_idname = "object.shape_key_label_parent"
+    bl_label = "Indent Label"
+    bl_description = "Make the active label a child of the label above it, or move it out of its parent"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    direction = bpy.props.EnumProperty(
+        name="Direction",
+        items = (
+                    ('IN', "Indent", "Make the label a child of the label above it"),
+                    ('OUT', "Outdent", "Move the label up to its parent's level"),
+               ),
+        default = 'IN'
+       )
 
     @classmethod
     def poll(cls, context):
         return label_poll(context, test_mode=False)
 
     def execute(self, context):
-        Shape_Key_Blabels(context).move(direction=self.type)
+        Shape_Key_Blabels(context).set_label_parent(self.direction)
         return {'FINISHED'}
 
 
 class ShapeKeySetIndex(bpy.types.Operator):
     bl_idname = "object.shape_key_set_index"
     bl_label = "Set Active Shape Key"
-    bl_description = "Set Active Shape Key"
-    bl_options = {'REGISTER', 'UNDO'}
+    bl_description = "Set Active Shape Key.  Ctrl toggles it in the selection, shift selects a range"
+    # Selecting doesn't push undo, see blabels.live_selections
+    bl_options = {'REGISTER'}
 
     index = bpy.props.IntProperty(default=-1)
     shift = bpy.props.BoolProperty(default=False)
+    ctrl = bpy.props.BoolProperty(default=False)
 
     @classmethod
     def poll(cls, context):
@@ -550,10 +1779,14 @@ class ShapeKeySetIndex(bpy.types.Operator):
 
     def invoke(self, context, event):
         self.shift = event.shift
+        self.ctrl = event.ctrl
         return self.execute(context)
 
     def execute(self, context):
-        Shape_Key_Blabels(context).select_item(self.index, self.shift)
+        Shape_Key_Blabels(context).select_item(self.index, add=self.ctrl, extend=self.shift)
+        # Only python state may have changed
+        if context.area:
+            context.area.tag_redraw()
         return {'FINISHED'}
 
 
@@ -564,6 +1797,7 @@ class ShapeKeyCopyToLabel(bpy.types.Operator):
     bl_options = {'REGISTER', 'UNDO'}
 
     index = bpy.props.IntProperty(default=-1)
+    all_selected = all_selected_property()
 
     @classmethod
     def poll(cls, context):
@@ -573,7 +1807,8 @@ class ShapeKeyCopyToLabel(bpy.types.Operator):
         pass
 
     def execute(self, context):
-        copied_to = Shape_Key_Blabels(context).copy_item(self.index)
+        copied_to = for_each_label_object(context, Shape_Key_Blabels, copy_to_label_func(context, Shape_Key_Blabels, self.index),
+                                          self.all_selected)
         if copied_to is not None:
             self.report({'INFO'}, "Copied to %s" % copied_to)
         return {'FINISHED'}
@@ -631,6 +1866,8 @@ class ShapeKeyDelete(bpy.types.Operator):
     bl_description = "Delete Shape Key"
     bl_options = {'REGISTER', 'UNDO'}
 
+    all_selected = all_selected_property()
+
     @classmethod
     def poll(cls, context):
         return label_poll(context, test_shapes=True)
@@ -639,7 +1876,7 @@ class ShapeKeyDelete(bpy.types.Operator):
         pass
 
     def execute(self, context):
-        Shape_Key_Blabels(context).delete_item()
+        for_each_label_object(context, Shape_Key_Blabels, lambda label_accessor: label_accessor.delete_item(), self.all_selected)
         return {'FINISHED'}
 
 
@@ -671,7 +1908,7 @@ class ShapeKeyToggleSelected(bpy.types.Operator):
     bl_idname = "object.shape_key_toggle_selected"
     bl_label = "Toggle Selected Shape Keys"
     bl_description = "Toggle Selected Shape Keys"
-    bl_options = {'REGISTER', 'UNDO'}
+    bl_options = {'REGISTER'}
 
     shift = bpy.props.BoolProperty(default=False)
 
@@ -688,6 +1925,8 @@ class ShapeKeyToggleSelected(bpy.types.Operator):
 
     def execute(self, context):
         Shape_Key_Blabels(context).toggle_selected_item(inverse=not self.shift)
+        if context.area:
+            context.area.tag_redraw()
         return {'FINISHED'}
 
 
@@ -697,6 +1936,7 @@ class ShapeKeyToggleVisible(bpy.types.Operator):
     bl_description = "Toggle Visible Shape Keys"
     bl_options = {'REGISTER', 'UNDO'}
     shift = bpy.props.BoolProperty(default=False)
+    all_selected = all_selected_property()
 
     @classmethod
     def poll(cls, context):
@@ -710,7 +1950,71 @@ class ShapeKeyToggleVisible(bpy.types.Operator):
         return self.execute(context)
 
     def execute(self, context):
-        Shape_Key_Blabels(context).toggle_visible_item(inverse=not self.shift)
+        for_each_label_object(context, Shape_Key_Blabels,
+                              lambda label_accessor: label_accessor.toggle_visible_item(inverse=not self.shift), self.all_selected)
+        return {'FINISHED'}
+
+
+class ShapeKeyPage(bpy.types.Operator):
+    bl_idname = "object.shape_key_page"
+    bl_label = "Change Shape Key Page"
+    bl_description = "Show another page of shape keys"
+    # Only changes what's drawn, so it doesn't need an undo step
+    bl_options = {'REGISTER'}
+
+    direction = bpy.props.EnumProperty(
+        name="Direction",
+        items = (
+                    ('FIRST', "First", "First page"),
+                    ('PREVIOUS', "Previous", "Previous page"),
+                    ('NEXT', "Next", "Next page"),
+                    ('LAST', "Last", "Last page"),
+                    ('ACTIVE', "Active", "Page with the active item"),
+               ),
+        default = 'NEXT'
+       )
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_shapes=True, test_mode=False)
+
+    def execute(self, context):
+        Shape_Key_Blabels(context).turn_page(self.direction)
+        return {'FINISHED'}
+
+
+class ShapeKeyApplyLabelRules(bpy.types.Operator):
+    bl_idname = "object.shape_key_apply_label_rules"
+    bl_label = "Apply Label Rules"
+    bl_description = "Add every shape key matching a label's rules to that label"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_shapes=True, test_mode=False)
+
+    def execute(self, context):
+        added = Shape_Key_Blabels(context).apply_rules(full=True)
+        self.report({'INFO'}, "Added %d shape keys to labels" % added)
+        return {'FINISHED'}
+
+
+class ShapeKeyReconcileLabels(bpy.types.Operator):
+    bl_idname = "object.shape_key_reconcile_labels"
+    bl_label = "Reconcile Labels"
+    bl_description = "Fix labels after shape keys were moved, renamed, added or deleted outside of the labels"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_shapes=True, test_mode=False)
+
+    def execute(self, context):
+        label_accessor = Shape_Key_Blabels(context)
+        remapped = label_accessor.reconcile()
+        dropped = label_accessor.validate()
+        if remapped or dropped:
+            self.report({'INFO'}, "Labels updated, %d invalid indexes dropped" % dropped)
         return {'FINISHED'}
 
 
@@ -735,8 +2039,21 @@ class MESH_MT_shape_key_copy_to_label(Menu):
         layout = self.layout
         obj = context.object
         for x, label in enumerate(obj.data.shape_key_labels):
-            if x > 0:
-                layout.operator("object.shape_key_copy_to_label", icon='FILE_FOLDER', text=label.name).index = x
+            if x > 0 and not label.is_query:
+                op = layout.operator("object.shape_key_copy_to_label", icon='FILE_FOLDER', text=label.name)
+                op.index = x
+                op.all_selected = context.scene.shape_keys_all_selected
+
+
+class MESH_MT_shape_key_pose_blend(Menu):
+    bl_label = "Blend to Pose"
+
+    def draw(self, context):
+        layout = self.layout
+        label = context.object.data.shape_key_labels[context.object.active_shape_key_label_index]
+        for x, pose in enumerate(label.poses):
+            if x != label.active_pose_index:
+                layout.operator("object.shape_key_pose_blend", icon='IPO', text=pose.name).index = x
 
 
 class NullOperator(bpy.types.Operator):
@@ -780,14 +2097,17 @@ class DATA_PT_shape_keys(MeshButtonsPanel, Panel):
 
         ##########################
         # LABELS LIST
-        layout.label("Labels")
+        all_selected = context.scene.shape_keys_all_selected
+        row = layout.row()
+        row.label("Labels")
+        row.prop(context.scene, "shape_keys_all_selected", text="All Selected")
         row = layout.row()
         row.template_list("MESH_UL_shape_key_blabels", "shape_key_labels", ob.data, "shape_key_labels", ob, "active_shape_key_label_index", rows=5)
 
         col = row.column()  # .split(percentage=0.5)
         sub = col.column(align=True)
-        sub.operator("object.shape_key_label_add", icon='ZOOMIN', text="")
-        sub.operator("object.shape_key_label_remove", icon='ZOOMOUT', text="")
+        sub.operator("object.shape_key_label_add", icon='ZOOMIN', text="").all_selected = all_selected
+        sub.operator("object.shape_key_label_remove", icon='ZOOMOUT', text="").all_selected = all_selected
 
 
         sub = col.column()
@@ -795,14 +2115,61 @@ class DATA_PT_shape_keys(MeshButtonsPanel, Panel):
         sub.scale_y = 4.9
 
         sub = col.column(align=True)
-        sub.operator("object.shape_key_label_move", icon='TRIA_UP', text="").type = 'UP'
-        sub.operator("object.shape_key_label_move", icon='TRIA_DOWN', text="").type = 'DOWN'
+        op = sub.operator("object.shape_key_label_move", icon='TRIA_UP', text="")
+        op.type = 'UP'
+        op.all_selected = all_selected
+        op = sub.operator("object.shape_key_label_move", icon='TRIA_DOWN', text="")
+        op.type = 'DOWN'
+        op.all_selected = all_selected
+        sub.operator("object.shape_key_label_parent", icon='FORWARD', text="").direction = 'IN'
+        sub.operator("object.shape_key_label_parent", icon='BACK', text="").direction = 'OUT'
 
 
         labels = ob.data.shape_key_labels
         if labels:
+            label = labels[ob.active_shape_key_label_index]
             row = layout.row()
-            row.prop(labels[ob.active_shape_key_label_index], 'name')
+            row.prop(label, 'name')
+            if ob.active_shape_key_label_index > 0:
+                row = layout.row(align=True)
+                row.prop(label, 'is_query', text="", icon='VIEWZOOM')
+                if label.is_query:
+                    row.prop(label, 'query_name', text="", icon='FILTER')
+                    draw_query_expression(layout, label_accessor, ob.active_shape_key_label_index)
+                    col = layout.column(align=True)
+                    col.prop(label, 'query_state', text="")
+                    row = col.row(align=True)
+                    row.prop(label, 'query_use_value', text="")
+                    sub = row.row(align=True)
+                    sub.active = label.query_use_value
+                    sub.prop(label, 'query_value_min')
+                    sub.prop(label, 'query_value_max')
+                    col.prop_search(label, 'query_vertex_group', ob, 'vertex_groups', text="")
+                else:
+                    row.prop(label, 'rules', text="", icon='FILTER')
+                    row.operator("object.shape_key_apply_label_rules", icon='FILE_REFRESH', text="")
+
+            if shape_keys:
+                row = layout.row(align=True)
+                row.operator("object.shape_key_solo_label", icon='SOLO_ON', text="Solo")
+                row.operator("object.shape_key_mute_label", icon='RESTRICT_VIEW_ON', text="Mute")
+                row.operator("object.shape_key_restore_mute", icon='RECOVER_LAST', text="Restore")
+
+            ##########################
+            # LABEL POSES
+            if shape_keys:
+                row = layout.row()
+                row.template_list("UI_UL_list", "shape_key_poses", label, "poses", label, "active_pose_index", rows=2)
+
+                col = row.column(align=True)
+                col.operator("object.shape_key_pose_add", icon='ZOOMIN', text="")
+                col.operator("object.shape_key_pose_remove", icon='ZOOMOUT', text="")
+
+                if label.poses:
+                    row = layout.row(align=True)
+                    row.operator("object.shape_key_pose_apply", text="Apply")
+                    row.menu("MESH_MT_shape_key_pose_blend", text="Blend")
+                    row.operator("object.shape_key_pose_reset", text="Reset")
 
 
         ##########################
@@ -814,9 +2181,11 @@ class DATA_PT_shape_keys(MeshButtonsPanel, Panel):
         side_col = col.column(align=True)
         side_col.operator("object.shape_key_add_to_label", icon='ZOOMIN', text="").from_mix = False
         side_col.operator("object.shape_key_remove_from_label", icon='ZOOMOUT', text="")
-        side_col.operator("object.shape_key_delete", icon='PANEL_CLOSE', text="")
+        side_col.operator("object.shape_key_delete", icon='PANEL_CLOSE', text="").all_selected = all_selected
 
-        indexes, selected = label_accessor.get_visible_item_indexes()
+        # Only the current page gets rows, so huge stacks draw as fast as small ones
+        num_indexes = len(indexes)
+        indexes, page, num_pages = label_accessor.get_page(indexes)
 
         if indexes:
             side_col.operator("object.shape_key_toggle", icon='RESTRICT_VIEW_OFF', text='')
@@ -845,9 +2214,14 @@ class DATA_PT_shape_keys(MeshButtonsPanel, Panel):
                 row = row.split()
                 row.menu("MESH_MT_shape_key_copy_to_label", text="Copy to Label")
 
+            ##########################
+            # SEARCH
+            draw_search(box, label_accessor, context.scene, "shape_keys_search", "shape_keys_search_mode")
+
         if indexes:
             ##########################
             # SHAPE KEYS
+            selected = set(selected)
             for i in indexes:
                 row = box.row(align=True)
                 row.scale_y = 0.8
@@ -876,7 +2250,12 @@ class DATA_PT_shape_keys(MeshButtonsPanel, Panel):
             row = row.split(percentage=0.91, align=True)
             row.label('')
 
-            row.operator("object.shape_key_toggle_visible", icon='VISIBLE_IPO_ON', text='')  # .absolute=True
+            row.operator("object.shape_key_toggle_visible", icon='VISIBLE_IPO_ON', text='').all_selected = all_selected
+
+            ##########################
+            # PAGES
+            if num_pages > 1:
+                draw_page_row(box, "object.shape_key_page", context.scene, "shape_keys_page_size", page, num_pages, num_indexes)
 
             ##########################
             # SIDE COLUMN BOTTOM ICONS
@@ -888,6 +2267,8 @@ class DATA_PT_shape_keys(MeshButtonsPanel, Panel):
 
             side_icons = 6 + 6
             button_space = len(indexes) * 24 - 4 + 30  # + 9 #shapekey row adds 30ish, Extra bottom row as padding adds 9ish.
+            if num_pages > 1:
+                button_space += 24
             side_space = side_icons * 20 + 4    # This may be incorrect if side_icons is less than 4
             space = button_space - side_space
             if space > 0:
@@ -964,11 +2345,62 @@ def label_index_updated(self, context):
     Shape_Key_Blabels(context).label_index_updated()
 
 
+def search_updated(self, context):
+    clear_search_cache()
+    if context.object and context.object.type in Shape_Key_Blabels.object_types:
+        Shape_Key_Blabels(context).page = 0
+
+
 def shape_key_specials(self, context):
     self.layout.operator(
         "object.shape_key_create_corrective",
         text="Create Corrective Driver",
         icon='LINK_AREA')
+    self.layout.operator(
+        "object.shape_key_batch_correctives",
+        text="Create Corrective Drivers for Label",
+        icon='LINK_AREA')
+    self.layout.operator(
+        "object.shape_key_analyze_drivers",
+        text="Analyze Drivers",
+        icon='INFO')
+    self.layout.operator(
+        "object.shape_key_find_duplicates",
+        text="Find Duplicate Shape Keys",
+        icon='VIEWZOOM')
+    self.layout.operator(
+        "object.shape_key_extract_vertex_groups",
+        text="Affected Vertices to Vertex Groups",
+        icon='GROUP_VERTEX')
+    self.layout.operator(
+        "object.shape_key_heatmap",
+        text="Shape Key Heatmap",
+        icon='COLOR')
+    self.layout.prop(context.scene, "shape_key_heatmap_live")
+    self.layout.operator(
+        "object.shape_key_export_label",
+        text="Export Label Shape Keys",
+        icon='EXPORT')
+    self.layout.operator(
+        "object.shape_key_import_label",
+        text="Import Label Shape Keys",
+        icon='IMPORT')
+    self.layout.operator(
+        "object.shape_key_keyframe_label",
+        text="Keyframe Label",
+        icon='KEY_HLT')
+    self.layout.operator(
+        "object.shape_key_mute_static",
+        text="Mute Static Shape Keys",
+        icon='RESTRICT_VIEW_ON')
+    self.layout.operator(
+        "object.shape_key_restore_mute",
+        text="Restore Mute State",
+        icon='RECOVER_LAST')
+    self.layout.operator(
+        "object.shape_key_reconcile_labels",
+        text="Reconcile Labels",
+        icon='FILE_REFRESH')
 
 old_shape_key_menu = None
 
@@ -977,8 +2409,11 @@ def register():
 
     # Add rna for Mesh object, to store label names and corresponding indexes.
     bpy.types.Mesh.shape_key_labels = bpy.props.CollectionProperty(type=IndexCollection)
-    bpy.types.Object.selected_shape_keys = bpy.props.CollectionProperty(type=IndexProperty)
+    bpy.types.Object.shape_key_selection = bpy.props.StringProperty(options={'HIDDEN'})
     bpy.types.Object.active_shape_key_label_index = bpy.props.IntProperty(default=0, update=label_index_updated)
+    bpy.types.Mesh.shape_key_mute_states = bpy.props.CollectionProperty(type=LabelPose)
+    bpy.types.Mesh.shape_key_fingerprint = bpy.props.StringProperty(options={'HIDDEN'})
+    bpy.types.Object.shape_key_page = bpy.props.IntProperty(default=0, min=0, options={'HIDDEN'})
 
     # Replace shapekeys panel with my own
     global old_shape_key_menu
@@ -997,10 +2432,45 @@ def register():
                 ('SELECTED', "Selected", "View Selected Shape Keys"),
                 ('VISIBLE', "Visible", "View Visible Shape Keys"),
                 ('HIDDEN', "Hidden", "View Hidden Shape Keys"),
+                ('DEPENDENCIES', "Dependencies", "View Shape Keys Driving the Active Shape Key"),
                ),
         )
 
+    bpy.types.Scene.shape_keys_all_selected = bpy.props.BoolProperty(
+        name="All Selected Objects",
+        default=False,
+        description="Run label operations on every selected object, matching labels and shape keys by name")
+
+    bpy.types.Scene.shape_keys_page_size = bpy.props.IntProperty(
+        name="Page Size",
+        default=50,
+        min=0,
+        description="Shape keys drawn per page.  0 draws them all")
+
+    bpy.types.Scene.shape_keys_search = bpy.props.StringProperty(
+        name="Search",
+        description="Only show shape keys with matching names",
+        update=search_updated)
+
+    bpy.types.Scene.shape_keys_search_mode = bpy.props.EnumProperty(
+        name="Search Mode",
+        items = (
+                    ('CONTAINS', "Contains", "Names containing the search"),
+                    ('PREFIX', "Starts With", "Names starting with the search"),
+                    ('REGEX', "Regular Expression", "Names matching the search as a regular expression"),
+               ),
+        default = 'CONTAINS',
+        update=search_updated)
+
+    bpy.types.Scene.shape_key_heatmap_live = bpy.props.BoolProperty(
+        name="Live Heatmap",
+        default=False,
+        description="Update the shape key heatmap whenever the active shape key changes",
+        update=heatmap_live_updated)
+
     bpy.types.MESH_MT_shape_key_specials.append(shape_key_specials)
+    bpy.app.handlers.scene_update_post.append(heatmap_update)
+    validated_classes.append(Shape_Key_Blabels)
 
     # try:
         # bpy.utils.register_module(__name__)
@@ -1013,8 +2483,15 @@ def unregister():
     # bpy.utils.unregister_module(__name__)
     bpy.utils.register_class(old_shape_key_menu)
     bpy.types.MESH_MT_shape_key_specials.remove(shape_key_specials)
+    bpy.app.handlers.scene_update_post.remove(heatmap_update)
+    validated_classes.remove(Shape_Key_Blabels)
 
     del bpy.types.Scene.shape_keys_view_mode
+    del bpy.types.Scene.shape_key_heatmap_live
+    del bpy.types.Scene.shape_keys_all_selected
+    del bpy.types.Scene.shape_keys_page_size
+    del bpy.types.Scene.shape_keys_search
+    del bpy.types.Scene.shape_keys_search_mode
 
     # Should I delete the rna types created?  Hmmmm.
     # I don't want a user to lose data from reloading my addon,
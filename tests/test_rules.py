@@ -0,0 +1,161 @@
+''' Label rules, run through the validation handler with a fake bpy, since
+the real one only exists inside Blender.  Run from the addon folder with
+
+    python -m unittest discover tests
+'''
+
+import importlib
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_blabels():
+    bpy = mock.MagicMock()
+    bpy.types.UIList = object
+    bpy.types.PropertyGroup = object
+    bpy.app.handlers.persistent = lambda func: func
+    modules = {
+        'bpy': bpy,
+        'bpy.types': bpy.types,
+        'bpy.app': bpy.app,
+        'bpy.app.handlers': bpy.app.handlers,
+        }
+    # Load the modules without the addon's __init__, which registers panels
+    package = types.ModuleType('blabels_addon')
+    package.__path__ = [ROOT]
+    modules['blabels_addon'] = package
+    with mock.patch.dict(sys.modules, modules):
+        return importlib.import_module('blabels_addon.blabels')
+
+blabels = import_blabels()
+
+
+class IndexProperty(object):
+    index = 0
+
+
+class IndexCollection(list):
+    def add(self):
+        self.append(IndexProperty())
+        return self[-1]
+
+    def remove(self, index):
+        del self[index]
+
+    def foreach_get(self, attr, values):
+        for x, item in enumerate(self):
+            values[x] = item.index
+
+    def foreach_set(self, attr, values):
+        for x, item in enumerate(self):
+            item.index = values[x]
+
+
+class Label(object):
+    def __init__(self, name, uid, rules=''):
+        self.name = name
+        self.uid = uid
+        self.parent_uid = 0
+        self.is_query = False
+        self.rules = rules
+        self.rules_evaluated = ''
+        self.rules_checked = ''
+        self.rules_matched = ''
+        self.indexes = IndexCollection()
+
+
+class Item(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class Items(list):
+    def keys(self):
+        return [item.name for item in self]
+
+
+class Object(object):
+    type = 'MESH'
+
+    def __init__(self, names, labels):
+        self.name = 'Mesh'
+        self.items = Items(Item(name) for name in names)
+        self.labels = labels
+        self.fingerprint = ''
+        self.selection = ''
+
+    def as_pointer(self):
+        return id(self)
+
+
+class Fake_Blabels(blabels.Blabels):
+    object_types = ('MESH',)
+    active_index = 0
+    active_item_index = 0
+
+    labels = property(lambda self: self.object.labels)
+    items = property(lambda self: self.object.items)
+
+    @property
+    def fingerprint(self):
+        return self.object.fingerprint
+
+    @fingerprint.setter
+    def fingerprint(self, data):
+        self.object.fingerprint = data
+
+    @property
+    def stored_selection(self):
+        return self.object.selection
+
+    @stored_selection.setter
+    def stored_selection(self, data):
+        self.object.selection = data
+
+
+class RuleTests(unittest.TestCase):
+    def setUp(self):
+        blabels.item_signatures.clear()
+        self.obj = Object(['Basis', 'brow_up', 'jaw_open', 'smile'],
+                          [Label('All', 0), Label('Brows', 1, rules='brow_*')])
+
+    def validate(self):
+        return blabels.validate_object(Fake_Blabels, self.obj)
+
+    def label_items(self):
+        label = self.obj.labels[1]
+        return sorted(self.obj.items[index.index].name for index in label.indexes)
+
+    def test_rules_fill_label(self):
+        self.validate()
+        self.assertEqual(self.label_items(), ['brow_up'])
+
+    def test_rename_adds_item(self):
+        self.validate()
+        # Same count, same active item, only a name changes
+        self.obj.items[3].name = 'brow_down'
+        self.validate()
+        self.assertEqual(self.label_items(), ['brow_down', 'brow_up'])
+
+    def test_rename_away_removes_item(self):
+        self.validate()
+        self.obj.items[1].name = 'forehead_up'
+        self.validate()
+        self.assertEqual(self.label_items(), [])
+
+    def test_rename_keeps_items_added_by_hand(self):
+        self.validate()
+        label = self.obj.labels[1]
+        label.indexes.add().index = 2
+        self.obj.items[2].name = 'chin_open'
+        self.validate()
+        self.assertEqual(self.label_items(), ['brow_up', 'chin_open'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -29,31 +29,35 @@ from .blabels import *
 class Vertex_Group_Blables(Blabels):
     @property
     def labels(self):
-        return self.context.object.vertex_group_labels
+        return self.object.vertex_group_labels
 
     @property
-    def selected_items(self):
-        return self.context.object.selected_vertex_group
+    def stored_selection(self):
+        return self.object.vertex_group_selection
+
+    @stored_selection.setter
+    def stored_selection(self, data):
+        self.object.vertex_group_selection = data
 
     @property
     def active_index(self):
-        return self.context.object.active_vertex_group_label_index
+        return self.object.active_vertex_group_label_index
 
     @active_index.setter
     def active_index(self, index):
-        self.context.object.active_vertex_group_label_index = index
+        self.object.active_vertex_group_label_index = index
 
     @property
     def active_item_index(self):
-        return self.context.object.vertex_groups.active_index
+        return self.object.vertex_groups.active_index
 
     @active_item_index.setter
     def active_item_index(self, index):
-        self.context.object.vertex_groups.active_index = index
+        self.object.vertex_groups.active_index = index
 
     @property
     def items(self):
-        obj = self.context.object
+        obj = self.object
         return obj.vertex_groups
 
     @property
@@ -62,21 +66,67 @@ class Vertex_Group_Blables(Blabels):
 
     @view_mode.setter
     def view_mode(self, mode):
-        context.scene.vertex_group_view_mode = mode.upper()
+        self.context.scene.vertex_group_view_mode = mode.upper()
+
+    def evaluate_query(self, label):
+        items = self.items
+        indexes = range(len(items))
+
+        match = compile_rules(label.query_name)
+        if match:
+            names = self.get_item_names()
+            indexes = [i for i in indexes if match(names[i])]
+        if label.query_state != 'ANY':
+            locks = self.get_cached_attribute('lock_weight', 'b')
+            locked = label.query_state == 'ON'
+            indexes = [i for i in indexes if bool(locks[i]) == locked]
+        if label.query_armature != 'ANY':
+            armature_groups = set(self.get_armature_groups())
+            in_armature = label.query_armature == 'IN'
+            indexes = [i for i in indexes if (i in armature_groups) == in_armature]
+        return indexes
+
+    @property
+    def search(self):
+        scene = self.context.scene
+        return scene.vertex_groups_search, scene.vertex_groups_search_mode
+
+    @property
+    def page(self):
+        return self.object.vertex_group_page
+
+    @page.setter
+    def page(self, page):
+        self.object.vertex_group_page = page
+
+    @property
+    def page_size(self):
+        return self.context.scene.vertex_groups_page_size
+
+    @property
+    def fingerprint(self):
+        return self.object.vertex_group_fingerprint
+
+    @fingerprint.setter
+    def fingerprint(self, data):
+        self.object.vertex_group_fingerprint = data
+
+    object_types = {'MESH', 'LATTICE'}
+    legacy_selection = 'selected_vertex_group'
 
     def add_item_orig(self, **add_item_kwargs):
         # I don't believe vertex groups have an optional parameter here yet.
-        bpy.ops.object.vertex_group_add(**add_item_kwargs)
+        self.call_operator(bpy.ops.object.vertex_group_add, **add_item_kwargs)
 
     def remove_item_orig(self, **remove_item_kwargs):
-        bpy.ops.object.vertex_group_remove(**remove_item_kwargs)
+        self.call_operator(bpy.ops.object.vertex_group_remove, **remove_item_kwargs)
 
     def move_item_orig(self, **move_item_kwargs):
-        # move_item_kwargs: type = self.type
-        bpy.ops.object.vertex_groups.move(**move_item_kwargs)
+        # move_item_kwargs: direction = self.direction
+        self.call_operator(bpy.ops.object.vertex_group_move, **move_item_kwargs)
 
     def get_armature_groups(self):
-        obj = self.context.object
+        obj = self.object
 
         # Find armature group.
         bones = []
@@ -127,8 +177,7 @@ class Vertex_Group_Blables(Blabels):
 
 def get_selected_groups():
     ''' Easy access wrapper for Vertex_Group_Blables '''
-    items = Vertex_Group_Blables().selected_items
-    return [i.index for i in items]
+    return Vertex_Group_Blables().get_selected()
 
 
 def get_active_group():
@@ -160,12 +209,17 @@ class VertexGroupsLabelAdd(bpy.types.Operator):
     bl_description = "Add Label"
     bl_options = {'REGISTER', 'UNDO'}
 
+    all_selected = all_selected_property()
+
     @classmethod
     def poll(cls, context):
         return label_poll(context, test_mode=False)
 
     def execute(self, context):
-        Vertex_Group_Blables(context).add()
+        # Give every object's new label the same name
+        name = "Label %d" % len(Vertex_Group_Blables(context).labels)
+        for_each_label_object(context, Vertex_Group_Blables, lambda label_accessor: label_accessor.add(name),
+                              self.all_selected, match_label=False)
         return {'FINISHED'}
 
 
@@ -175,12 +229,14 @@ class VertexGroupsLabelRemove(bpy.types.Operator):
     bl_description = "Remove Label"
     bl_options = {'REGISTER', 'UNDO'}
 
+    all_selected = all_selected_property()
+
     @classmethod
     def poll(cls, context):
         return label_poll(context, test_mode=False)
 
     def execute(self, context):
-        copied_to = Vertex_Group_Blables(context).remove()
+        for_each_label_object(context, Vertex_Group_Blables, lambda label_accessor: label_accessor.remove(), self.all_selected)
         return {'FINISHED'}
 
 
@@ -198,24 +254,52 @@ class VertexGroupsLabelMove(bpy.types.Operator):
                ),
         default = 'UP'
        )
+    all_selected = all_selected_property()
 
     @classmethod
     def poll(cls, context):
         return label_poll(context, test_mode=False)
 
     def execute(self, context):
-        Vertex_Group_Blables(context).move(direction=self.direction)
+        for_each_label_object(context, Vertex_Group_Blables,
+                              lambda label_accessor: label_accessor.move(direction=self.direction), self.all_selected)
+        return {'FINISHED'}
+
+
+class VertexGroupsLabelParent(bpy.types.Operator):
+    bl_idname = "object.vertex_groups_label_parent"
+    bl_label = "Indent Label"
+    bl_description = "Make the active label a child of the label above it, or move it out of its parent"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    direction = bpy.props.EnumProperty(
+        name="Direction",
+        items = (
+                    ('IN', "Indent", "Make the label a child of the label above it"),
+                    ('OUT', "Outdent", "Move the label up to its parent's level"),
+               ),
+        default = 'IN'
+       )
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_mode=False)
+
+    def execute(self, context):
+        Vertex_Group_Blables(context).set_label_parent(self.direction)
         return {'FINISHED'}
 
 
 class VertexGroupsSetIndex(bpy.types.Operator):
     bl_idname = "object.vertex_groups_set_index"
     bl_label = "Set Active Vertex Groups"
-    bl_description = "Set Active Vertex Groups"
-    bl_options = {'REGISTER', 'UNDO'}
+    bl_description = "Set Active Vertex Group.  Ctrl toggles it in the selection, shift selects a range"
+    # Selecting doesn't push undo, see blabels.live_selections
+    bl_options = {'REGISTER'}
 
     index = bpy.props.IntProperty(default=-1)
     shift = bpy.props.BoolProperty(default=False)
+    ctrl = bpy.props.BoolProperty(default=False)
 
     @classmethod
     def poll(cls, context):
@@ -223,10 +307,14 @@ class VertexGroupsSetIndex(bpy.types.Operator):
 
     def invoke(self, context, event):
         self.shift = event.shift
+        self.ctrl = event.ctrl
         return self.execute(context)
 
     def execute(self, context):
-        Vertex_Group_Blables(context).select_item(self.index, self.shift)
+        Vertex_Group_Blables(context).select_item(self.index, add=self.ctrl, extend=self.shift)
+        # Only python state may have changed
+        if context.area:
+            context.area.tag_redraw()
         return {'FINISHED'}
 
 
@@ -237,13 +325,15 @@ class VertexGroupsCopyToLabel(bpy.types.Operator):
     bl_options = {'REGISTER', 'UNDO'}
 
     index = bpy.props.IntProperty(default=-1)
+    all_selected = all_selected_property()
 
     @classmethod
     def poll(cls, context):
         return label_poll(context, test_groups=True)
 
     def execute(self, context):
-        copied_to = Vertex_Group_Blables(context).copy_item(self.index)
+        copied_to = for_each_label_object(context, Vertex_Group_Blables, copy_to_label_func(context, Vertex_Group_Blables, self.index),
+                                          self.all_selected)
         if copied_to is not None:
             self.report({'INFO'}, "Copied to %s" % copied_to)
         return {'FINISHED'}
@@ -286,12 +376,14 @@ class VertexGroupsDelete(bpy.types.Operator):
     bl_description = "Delete Vertex Groups"
     bl_options = {'REGISTER', 'UNDO'}
 
+    all_selected = all_selected_property()
+
     @classmethod
     def poll(cls, context):
         return label_poll(context, test_groups=True)
 
     def execute(self, context):
-        Vertex_Group_Blables(context).delete_item()
+        for_each_label_object(context, Vertex_Group_Blables, lambda label_accessor: label_accessor.delete_item(), self.all_selected)
         return {'FINISHED'}
 
 
@@ -323,7 +415,7 @@ class VertexGroupsToggleSelected(bpy.types.Operator):
     bl_idname = "object.vertex_groups_toggle_selected"
     bl_label = "Toggle Selected Vertex Groups"
     bl_description = "Toggle Selected Vertex Groups"
-    bl_options = {'REGISTER', 'UNDO'}
+    bl_options = {'REGISTER'}
 
     shift = bpy.props.BoolProperty(default=False)
 
@@ -337,6 +429,8 @@ class VertexGroupsToggleSelected(bpy.types.Operator):
 
     def execute(self, context):
         Vertex_Group_Blables(context).toggle_selected_item(inverse=not self.shift)
+        if context.area:
+            context.area.tag_redraw()
         return {'FINISHED'}
 
 
@@ -347,6 +441,7 @@ class VertexGroupsToggleLocked(bpy.types.Operator):
     bl_options = {'REGISTER', 'UNDO'}
 
     shift = bpy.props.BoolProperty(default=False)
+    all_selected = all_selected_property()
 
     @classmethod
     def poll(cls, context):
@@ -357,7 +452,71 @@ class VertexGroupsToggleLocked(bpy.types.Operator):
         return self.execute(context)
 
     def execute(self, context):
-        Vertex_Group_Blables(context).toggle_locked_item(inverse=not self.shift)
+        for_each_label_object(context, Vertex_Group_Blables,
+                              lambda label_accessor: label_accessor.toggle_locked_item(inverse=not self.shift), self.all_selected)
+        return {'FINISHED'}
+
+
+class VertexGroupsPage(bpy.types.Operator):
+    bl_idname = "object.vertex_groups_page"
+    bl_label = "Change Vertex Group Page"
+    bl_description = "Show another page of vertex groups"
+    # Only changes what's drawn, so it doesn't need an undo step
+    bl_options = {'REGISTER'}
+
+    direction = bpy.props.EnumProperty(
+        name="Direction",
+        items = (
+                    ('FIRST', "First", "First page"),
+                    ('PREVIOUS', "Previous", "Previous page"),
+                    ('NEXT', "Next", "Next page"),
+                    ('LAST', "Last", "Last page"),
+                    ('ACTIVE', "Active", "Page with the active item"),
+               ),
+        default = 'NEXT'
+       )
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_groups=True, test_mode=False)
+
+    def execute(self, context):
+        Vertex_Group_Blables(context).turn_page(self.direction)
+        return {'FINISHED'}
+
+
+class VertexGroupsApplyLabelRules(bpy.types.Operator):
+    bl_idname = "object.vertex_groups_apply_label_rules"
+    bl_label = "Apply Label Rules"
+    bl_description = "Add every vertex group matching a label's rules to that label"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_groups=True, test_mode=False)
+
+    def execute(self, context):
+        added = Vertex_Group_Blables(context).apply_rules(full=True)
+        self.report({'INFO'}, "Added %d vertex groups to labels" % added)
+        return {'FINISHED'}
+
+
+class VertexGroupsReconcileLabels(bpy.types.Operator):
+    bl_idname = "object.vertex_groups_reconcile_labels"
+    bl_label = "Reconcile Labels"
+    bl_description = "Fix labels after vertex groups were moved, renamed, added or deleted outside of the labels"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return label_poll(context, test_groups=True, test_mode=False)
+
+    def execute(self, context):
+        label_accessor = Vertex_Group_Blables(context)
+        remapped = label_accessor.reconcile()
+        dropped = label_accessor.validate()
+        if remapped or dropped:
+            self.report({'INFO'}, "Labels updated, %d invalid indexes dropped" % dropped)
         return {'FINISHED'}
 
 
@@ -382,8 +541,10 @@ class MESH_MT_vertex_groups_copy_to_label(Menu):
         layout = self.layout
         obj = context.object
         for x, label in enumerate(obj.vertex_group_labels):
-            if x > 0:
-                layout.operator("object.vertex_groups_copy_to_label", icon='FILE_FOLDER', text=label.name).index = x
+            if x > 0 and not label.is_query:
+                op = layout.operator("object.vertex_groups_copy_to_label", icon='FILE_FOLDER', text=label.name)
+                op.index = x
+                op.all_selected = context.scene.vertex_groups_all_selected
 
 
 ##################################
@@ -412,14 +573,17 @@ class DATA_PT_vertex_groups(MeshButtonsPanel, Panel):
 
         ##########################
         # LABELS LIST
-        layout.label("Labels")
+        all_selected = context.scene.vertex_groups_all_selected
+        row = layout.row()
+        row.label("Labels")
+        row.prop(context.scene, "vertex_groups_all_selected", text="All Selected")
         row = layout.row()
         row.template_list("MESH_UL_vgroup_blabels", "", ob, "vertex_group_labels", ob, "active_vertex_group_label_index", rows=5)
 
         col = row.column()
         sub = col.column(align=True)
-        sub.operator("object.vertex_groups_label_add", icon='ZOOMIN', text="")
-        sub.operator("object.vertex_groups_label_remove", icon='ZOOMOUT', text="")
+        sub.operator("object.vertex_groups_label_add", icon='ZOOMIN', text="").all_selected = all_selected
+        sub.operator("object.vertex_groups_label_remove", icon='ZOOMOUT', text="").all_selected = all_selected
 
 
         sub = col.column()
@@ -427,14 +591,33 @@ class DATA_PT_vertex_groups(MeshButtonsPanel, Panel):
         sub.scale_y = 4.9
 
         sub = col.column(align=True)
-        sub.operator("object.vertex_groups_label_move", icon='TRIA_UP', text="").direction = 'UP'
-        sub.operator("object.vertex_groups_label_move", icon='TRIA_DOWN', text="").direction = 'DOWN'
+        op = sub.operator("object.vertex_groups_label_move", icon='TRIA_UP', text="")
+        op.direction = 'UP'
+        op.all_selected = all_selected
+        op = sub.operator("object.vertex_groups_label_move", icon='TRIA_DOWN', text="")
+        op.direction = 'DOWN'
+        op.all_selected = all_selected
+        sub.operator("object.vertex_groups_label_parent", icon='FORWARD', text="").direction = 'IN'
+        sub.operator("object.vertex_groups_label_parent", icon='BACK', text="").direction = 'OUT'
 
 
         labels = Vertex_Group_Blables(context).labels
         if labels:
+            label = Vertex_Group_Blables(context).active_label
             row = layout.row()
-            row.prop(Vertex_Group_Blables(context).active_label, 'name')
+            row.prop(label, 'name')
+            if ob.active_vertex_group_label_index > 0:
+                row = layout.row(align=True)
+                row.prop(label, 'is_query', text="", icon='VIEWZOOM')
+                if label.is_query:
+                    row.prop(label, 'query_name', text="", icon='FILTER')
+                    draw_query_expression(layout, Vertex_Group_Blables(context), ob.active_vertex_group_label_index)
+                    row = layout.row(align=True)
+                    row.prop(label, 'query_state', text="")
+                    row.prop(label, 'query_armature', text="")
+                else:
+                    row.prop(label, 'rules', text="", icon='FILTER')
+                    row.operator("object.vertex_groups_apply_label_rules", icon='FILE_REFRESH', text="")
 
         ##########################
         # SIDE COLUMN ICONS
@@ -445,10 +628,15 @@ class DATA_PT_vertex_groups(MeshButtonsPanel, Panel):
         side_col = col.column(align=True)
         side_col.operator("object.vertex_groups_add_to_label", icon='ZOOMIN', text="")
         side_col.operator("object.vertex_groups_remove_from_label", icon='ZOOMOUT', text="")
-        side_col.operator("object.vertex_groups_delete", icon='PANEL_CLOSE', text="")
+        side_col.operator("object.vertex_groups_delete", icon='PANEL_CLOSE', text="").all_selected = all_selected
 
         side_col.menu("MESH_MT_vertex_group_specials", icon='DOWNARROW_HLT', text="")
-        indexes, selected = Vertex_Group_Blables(context).get_visible_item_indexes()
+        label_accessor = Vertex_Group_Blables(context)
+        indexes, selected = label_accessor.get_visible_item_indexes()
+
+        # Only the current page gets rows, so huge lists draw as fast as small ones
+        num_indexes = len(indexes)
+        indexes, page, num_pages = label_accessor.get_page(indexes)
 
         if len(ob.vertex_groups):
             row = box.row()
@@ -465,9 +653,14 @@ class DATA_PT_vertex_groups(MeshButtonsPanel, Panel):
                 row = row.split()
                 row.menu("MESH_MT_vertex_groups_copy_to_label", text="Copy to Label")
 
+            ##########################
+            # SEARCH
+            draw_search(box, label_accessor, context.scene, "vertex_groups_search", "vertex_groups_search_mode")
+
         if indexes:
             ##########################
             # VERTEX GROUP ITEMS
+            selected = set(selected)
             for i in indexes:
                 row = box.row(align=True)
                 row.scale_y = 0.8
@@ -497,7 +690,12 @@ class DATA_PT_vertex_groups(MeshButtonsPanel, Panel):
             row = row.split(percentage=0.91, align=True)
             row.label('')
 
-            row.operator("object.vertex_groups_toggle_locked", icon='UNLOCKED', text='')  # .absolute=True
+            row.operator("object.vertex_groups_toggle_locked", icon='UNLOCKED', text='').all_selected = all_selected
+
+            ##########################
+            # PAGES
+            if num_pages > 1:
+                draw_page_row(box, "object.vertex_groups_page", context.scene, "vertex_groups_page_size", page, num_pages, num_indexes)
 
             ##########################
             # SIDE COLUMN BOTTOM ICONS
@@ -509,6 +707,8 @@ class DATA_PT_vertex_groups(MeshButtonsPanel, Panel):
 
             side_icons = 6
             button_space = len(indexes) * 24 - 4 + 30  # + 9 #shapekey row adds 30ish, Extra bottom row as padding adds 9ish.
+            if num_pages > 1:
+                button_space += 24
             side_space = side_icons * 20 + 4    # This may be incorrect if side_icons is less than 4
             space = button_space - side_space
             if space > 0:
@@ -547,11 +747,26 @@ def label_index_updated(self, context):
 old_vertex_group_menu = None
 
 
+def search_updated(self, context):
+    clear_search_cache()
+    if context.object and context.object.type in Vertex_Group_Blables.object_types:
+        Vertex_Group_Blables(context).page = 0
+
+
+def vertex_group_specials(self, context):
+    self.layout.operator(
+        "object.vertex_groups_reconcile_labels",
+        text="Reconcile Labels",
+        icon='FILE_REFRESH')
+
+
 def register():
     # Add rna for Mesh object, to store label names and corresponding indexes.
     bpy.types.Object.vertex_group_labels = bpy.props.CollectionProperty(type=IndexCollection)
-    bpy.types.Object.selected_vertex_group = bpy.props.CollectionProperty(type=IndexProperty)
+    bpy.types.Object.vertex_group_selection = bpy.props.StringProperty(options={'HIDDEN'})
     bpy.types.Object.active_vertex_group_label_index = bpy.props.IntProperty(default=0)
+    bpy.types.Object.vertex_group_fingerprint = bpy.props.StringProperty(options={'HIDDEN'})
+    bpy.types.Object.vertex_group_page = bpy.props.IntProperty(default=0, min=0, options={'HIDDEN'})
 
     # Replace shapekeys panel with my own
     global old_vertex_group_menu
@@ -568,6 +783,35 @@ def register():
                ),
        )
 
+    bpy.types.Scene.vertex_groups_all_selected = bpy.props.BoolProperty(
+        name="All Selected Objects",
+        default=False,
+        description="Run label operations on every selected object, matching labels and vertex groups by name")
+
+    bpy.types.Scene.vertex_groups_page_size = bpy.props.IntProperty(
+        name="Page Size",
+        default=50,
+        min=0,
+        description="Vertex groups drawn per page.  0 draws them all")
+
+    bpy.types.Scene.vertex_groups_search = bpy.props.StringProperty(
+        name="Search",
+        description="Only show vertex groups with matching names",
+        update=search_updated)
+
+    bpy.types.Scene.vertex_groups_search_mode = bpy.props.EnumProperty(
+        name="Search Mode",
+        items = (
+                    ('CONTAINS', "Contains", "Names containing the search"),
+                    ('PREFIX', "Starts With", "Names starting with the search"),
+                    ('REGEX', "Regular Expression", "Names matching the search as a regular expression"),
+               ),
+        default = 'CONTAINS',
+        update=search_updated)
+
+    bpy.types.MESH_MT_vertex_group_specials.append(vertex_group_specials)
+    validated_classes.append(Vertex_Group_Blables)
+
     # try:
         # bpy.utils.register_module(__name__)
     # except Exception as err:
@@ -578,8 +822,14 @@ def register():
 def unregister():
     # bpy.utils.unregister_module(__name__)
     bpy.utils.register_class(old_vertex_group_menu)
+    bpy.types.MESH_MT_vertex_group_specials.remove(vertex_group_specials)
+    validated_classes.remove(Vertex_Group_Blables)
 
     del bpy.types.Scene.vertex_group_view_mode
+    del bpy.types.Scene.vertex_groups_all_selected
+    del bpy.types.Scene.vertex_groups_page_size
+    del bpy.types.Scene.vertex_groups_search
+    del bpy.types.Scene.vertex_groups_search_mode
 
     # Should I delete the rna types created?  Hmmmm.
     # I don't want a user to lose data from reloading my addon,